@@ -0,0 +1,243 @@
+import sys
+import time
+import asyncio
+import itertools
+from copy import copy
+from datasource import RecordChunk, BaseReader, GenericReader, PAGINATION_MODES, where
+from slicer import insert_statements, task_id
+from metrics import metrics
+
+try:
+    import aiomysql
+    from pymysql.converters import escape_item
+except ImportError:
+    aiomysql = None
+
+# slices tables on a single event loop: reads, writes and cupboard calls of all tables
+# are multiplexed over connection pools, each kind limited by its own semaphore
+class AsyncSlicingMachine:
+    __CHUNK_SIZE = 20000
+    __RECORDS_CHUNK_SIZE = 5000
+
+    def __init__(self, registry, read_parameters, write_parameters, cupboard, reader_options = None, writer_options = None,
+                 tables = 16, reads = 8, writes = 4, cupboard_calls = 4, reference_split_size = 100000, resume = False):
+        assert aiomysql, 'Async engine requires aiomysql package'
+        self.registry = registry
+        self.read_parameters = read_parameters
+        self.write_parameters = write_parameters
+        self.cupboard = cupboard
+        self.reader_options = reader_options if reader_options else {}
+        self.writer_options = writer_options if writer_options else {}
+        self.tables = tables
+        self.reads = reads
+        self.writes = writes
+        self.cupboard_calls = cupboard_calls
+        self.reference_split_size = reference_split_size
+        self.resume = resume
+
+        assert self.writer_options.get('backend', 'insert') == 'insert', 'Async engine writes with INSERT statements only'
+        if self.reader_options.get('streaming'):
+            print('Async engine reads in pages, streaming is ignored')
+
+    async def run(self, tasks):
+        # semaphores are bound to the running loop
+        self.write_slots = asyncio.Semaphore(self.writes)
+        self.cupboard_slots = asyncio.Semaphore(self.cupboard_calls)
+        table_slots = asyncio.Semaphore(self.tables)
+        session = 'SET SESSION foreign_key_checks=0' + (', unique_checks=0' if self.writer_options.get('fast_load') else '')
+        read_pools = [await aiomysql.create_pool(**pool_parameters(parameters, self.reads)) for parameters in self.read_parameters]
+        # reads are limited per read connection (server), each pool with its own semaphore
+        self.read_pools = itertools.cycle([(pool, asyncio.Semaphore(self.reads),) for pool in read_pools])
+        self.write_pool = await aiomysql.create_pool(**pool_parameters(self.write_parameters, self.writes, session))
+
+        async def slice_task(task):
+            async with table_slots:
+                await self.slice_table(*task)
+
+        try:
+            await asyncio.gather(*[slice_task(task) for task in tasks])
+            await self.persist_references()
+        finally:
+            for pool in read_pools + [self.write_pool]:
+                pool.close()
+                await pool.wait_closed()
+
+    async def slice_table(self, table, key_range = None):
+        task = task_id(key_range)
+        checkpoint = await self.__cupboard(self.cupboard.load_checkpoint, table, task) if self.resume else None
+        metrics.start_task(table)
+        try:
+            if checkpoint and checkpoint['done']:
+                print('Skip table:', table, '[%s, %s)' % key_range if key_range else '', '(already copied)')
+                return
+            reader = copy(self.registry.get_table_reader(table))
+            # tables copied upon request only are not read
+            if isinstance(reader, GenericReader):
+                return
+            if key_range:
+                reader.set_key_range(*key_range)
+            print('Start table:', table, '[%s, %s)' % key_range if key_range else '')
+            await self.__slice(table, task, reader, checkpoint)
+            await self.__cupboard(self.cupboard.save_checkpoint, table, task, {'last_key': None, 'done': True})
+            print('Commit table:', table)
+        except Exception:
+            print('Error when copying table "%s"' % (table,))
+            print(sys.exc_info()[1])
+        finally:
+            metrics.finish_task(table)
+
+    async def __slice(self, table, task, reader, checkpoint):
+        pagination = self.reader_options.get('pagination', 'keyset')
+        assert pagination in PAGINATION_MODES, 'Unknown pagination mode %s' % (pagination,)
+        seek_field = reader.seek_field() if pagination == 'keyset' else None
+        # joins are always pushed to the server as IN (SELECT ...), so only own key order matters
+        resumable = BaseReader.resumable(reader, pagination)
+        chunk_size = self.__CHUNK_SIZE
+        sql, conditions = reader.sql_select(), reader.sql_conditions()
+
+        if seek_field:
+            seek_column = '`%s`.`%s`' % (table, seek_field,)
+            seek_index = reader.fields['__order__'].index(seek_field)
+            order = ' ORDER BY %s LIMIT %%s' % (seek_column,)
+            seek_sql = where(sql, conditions + [seek_column + ' > %s']) + order
+            if checkpoint and checkpoint['last_key'] is not None and resumable:
+                print('Resume table:', table, 'after key', checkpoint['last_key'])
+                page_sql, params = seek_sql, (checkpoint['last_key'], chunk_size,)
+            else:
+                page_sql, params = where(sql, conditions) + order, (chunk_size,)
+        else:
+            page_sql, params = where(sql, conditions) + ' LIMIT %s, %s', (0, chunk_size,)
+
+        # the next page is read while the previous one is written, writes keep their order
+        writing = None
+        try:
+            while True:
+                started_at = time.time()
+                rows = await self.__read(page_sql, params)
+                metrics.add(table, 'fetch', time.time() - started_at, len(rows))
+                if rows:
+                    chunk = RecordChunk(reader.encoder, rows)
+                    if writing:
+                        await writing
+                    writing = asyncio.ensure_future(self.__persist(
+                        table, chunk, self.resume, (task, chunk.last_key() if resumable else None,)
+                    ))
+                if len(rows) < chunk_size:
+                    break
+                if seek_field:
+                    page_sql, params = seek_sql, (rows[-1][seek_index], chunk_size,)
+                else:
+                    params = (params[0] + chunk_size, chunk_size,)
+            if writing:
+                await writing
+        except BaseException:
+            if writing:
+                writing.cancel()
+            raise
+
+    # every chunk is a transaction of its own, so write connections are held only while writing
+    async def __persist(self, table, chunk, ignore_duplicates, checkpoint = None):
+        started_at = time.time()
+        primary_keys = chunk.primary_keys()
+        references = list(chunk.references())
+        statements = list(insert_statements(
+            table, self.registry.metadata[table]['fields']['__order__'], list(chunk.sql_values()), ignore_duplicates
+        ))
+        metrics.add(table, 'encode', time.time() - started_at, len(chunk))
+
+        started_at = time.time()
+        async with self.write_slots:
+            async with self.write_pool.acquire() as connection:
+                try:
+                    async with connection.cursor() as cursor:
+                        for statement in statements:
+                            await cursor.execute(statement)
+                    await connection.commit()
+                except BaseException:
+                    await connection.rollback()
+                    raise
+        metrics.add(table, 'persist', time.time() - started_at, len(chunk), sum([len(statement) for statement in statements]))
+
+        await self.__cupboard(self.cupboard.put_on_shelf, table, *primary_keys)
+        await self.__cupboard(self.cupboard.put_on_reference_shelf, references)
+        if checkpoint:
+            task, last_key = checkpoint
+            await self.__cupboard(self.cupboard.save_checkpoint, table, task, {'last_key': last_key, 'done': False})
+
+    async def persist_references(self):
+        while await self.__cupboard(self.cupboard.has_pending_references):
+            print('Iteration over references')
+            started_at = time.time()
+            references = await self.__cupboard(
+                lambda: [(table, list(record_keys),) for table, record_keys in self.cupboard.get_all_references()]
+            )
+            tables = [table for table, _ in references]
+            results = await asyncio.gather(*[
+                self.persist_table_references(table, record_keys[offset:offset+self.reference_split_size])
+                for table, record_keys in references
+                for offset in range(0, len(record_keys), self.reference_split_size)
+            ])
+            failed = set([table for table, done in results if not done])
+            for table in set(tables) - failed:
+                await self.__cupboard(self.cupboard.release_references, table)
+            metrics.add_iteration(len(tables), sum([len(record_keys) for _, record_keys in references]), time.time() - started_at)
+            # unreleased references are handed out again by a resumed run
+            if failed:
+                print('Copying references failed, run again with --continue to resume')
+                return
+
+    async def persist_table_references(self, table, record_keys):
+        started_at = time.time()
+        reader = copy(self.registry.get_table_reader(table))
+        reader.set_connection(Literals())
+        try:
+            for offset in range(0, len(record_keys), self.__RECORDS_CHUNK_SIZE):
+                fetch_started_at = time.time()
+                rows = await self.__read(reader.sql_records(*record_keys[offset:offset+self.__RECORDS_CHUNK_SIZE]))
+                metrics.add(table, 'fetch', time.time() - fetch_started_at, len(rows))
+                if rows:
+                    await self.__persist(table, RecordChunk(reader.encoder, rows), True)
+            print('References for table "' + table + '":', len(record_keys))
+            done = True
+        except Exception:
+            print('Error when copying references to "%s"' % (table,))
+            print(sys.exc_info()[1])
+            done = False
+        metrics.add(table, 'references', time.time() - started_at, len(record_keys))
+
+        return (table, done,)
+
+    async def __read(self, sql, params = None):
+        pool, read_slots = next(self.read_pools)
+        async with read_slots:
+            async with pool.acquire() as connection:
+                async with connection.cursor() as cursor:
+                    await cursor.execute(sql, params)
+                    rows = await cursor.fetchall()
+                # nothing is changed, the snapshot is just released
+                await connection.rollback()
+        return rows
+
+    # cupboards are synchronous, their calls run in the default executor
+    async def __cupboard(self, method, *args):
+        async with self.cupboard_slots:
+            return await asyncio.get_event_loop().run_in_executor(None, lambda: method(*args))
+
+# quotes keys for BaseReader.sql_records the way MySQLdb connections do
+class Literals:
+    def literal(self, value):
+        return escape_item(value, 'utf8').encode('utf-8')
+
+def pool_parameters(parameters, size, init_command = None):
+    return {
+        'host': parameters['host'],
+        'port': parameters['port'],
+        'user': parameters['user'],
+        'password': parameters['password'] if parameters['password'] else '',
+        'db': parameters['database'],
+        'charset': 'utf8',
+        'autocommit': False,
+        'minsize': 1,
+        'maxsize': size,
+        'init_command': init_command,
+    }
@@ -0,0 +1,155 @@
+import datetime
+import random
+import sys
+import timeit
+import tracemalloc
+from decimal import Decimal
+from datasource import BaseReader, RecordChunk
+
+# python3 -m benchmarks.encoder [rows]
+#
+# compares RecordEncoder and RecordChunk with the former per-row populate_record
+# implementation, in speed, memory and output (which has to be identical)
+
+def legacy_populate_record(table, fields, references, record_data):
+    def __cast_number(value):
+        return int(value)
+    def __cast_decimal(value):
+        return float(value)
+    def __cast_string(value):
+        return '"{}"'.format(str(value).replace('\\', '\\\\').replace('"', '\\"'))
+    def __cast_datetime(value):
+        return __cast_string(value) if value else '"0000-00-00 00:00:00"'
+    def __cast_date(value):
+        return __cast_string(value) if value else '"0000-00-00"'
+    def __cast_time(value):
+        return __cast_string(value) if value else '"00:00:00"'
+
+    cast_map = {
+        'int': __cast_number,
+        'bigint': __cast_number,
+        'smallint': __cast_number,
+        'tinyint': __cast_number,
+        'decimal': __cast_decimal,
+        'double': __cast_decimal,
+        'double': __cast_decimal,
+        'char': __cast_string,
+        'varchar': __cast_string,
+        'text': __cast_string,
+        'longtext': __cast_string,
+        'date': __cast_date,
+        'time': __cast_time,
+        'datetime': __cast_datetime,
+        'enum': __cast_string,
+    }
+    primary_key = ''
+    record_key = table
+    record = list()
+    record_references = dict()
+
+    for field, value in zip(fields['__order__'], record_data):
+        if field == fields['__primary__']:
+            primary_key = value
+            record_key += ':' + str(value)
+        if value == None and fields[field]['null'] == 'YES':
+            quoted_value = 'NULL'
+        else:
+            cast_type = cast_map.get(fields[field]['type'], __cast_string)
+            quoted_value = cast_type(value)
+        record.append(str(quoted_value))
+        if field in references:
+            record_references[references[field][0]] = value
+
+    return {
+        'primary_key': primary_key,
+        'record_key': record_key,
+        'record': '(%s)' % (','.join(record),),
+        'references': record_references,
+    }
+
+COLUMNS = [
+    ('id', 'int', 'NO'),
+    ('user_id', 'bigint', 'YES'),
+    ('city_id', 'int', 'NO'),
+    ('status', 'enum', 'NO'),
+    ('price', 'decimal', 'YES'),
+    ('rate', 'double', 'NO'),
+    ('title', 'varchar', 'NO'),
+    ('description', 'text', 'YES'),
+    ('created_at', 'datetime', 'NO'),
+    ('birthday', 'date', 'YES'),
+    ('opens_at', 'time', 'NO'),
+    ('payload', 'blob', 'YES'),
+]
+
+def table_fields():
+    fields = {'__primary__': 'id', '__order__': [name for name, _, _ in COLUMNS]}
+    for name, type, null in COLUMNS:
+        fields[name] = {'name': name, 'index': 'PRI' if name == 'id' else '', 'type': type, 'null': null}
+    return fields
+
+def random_row(index):
+    return (
+        index,
+        random.choice([None, random.randint(1, 10 ** 12)]),
+        random.randint(1, 500),
+        random.choice(['new', 'paid', 'cancelled']),
+        random.choice([None, Decimal(random.randint(0, 10 ** 6)) / 100]),
+        random.random() * 1000,
+        'Title "%d" with \\ backslash' % (index,),
+        random.choice([None, 'Lorem ipsum dolor sit amet, "consectetur"\n adipiscing elit. ' * random.randint(1, 20)]),
+        random.choice([None, datetime.datetime(2017, 1, 1) + datetime.timedelta(seconds=random.randint(0, 10 ** 8))]),
+        random.choice([None, datetime.date(1950, 1, 1) + datetime.timedelta(days=random.randint(0, 20000))]),
+        random.choice([datetime.timedelta(0), datetime.timedelta(seconds=random.randint(0, 86399))]),
+        random.choice([None, b'\x00\x01binary']),
+    )
+
+def random_rows(rows):
+    random.seed(42)
+    return [random_row(index) for index in range(1, rows + 1)]
+
+def main(rows):
+    fields = table_fields()
+    table_references = {'user_id': ('users', 'id'), 'city_id': ('cities', 'id')}
+    reader = BaseReader('orders', fields, table_references)
+    data = random_rows(rows)
+
+    chunk = RecordChunk(reader.encoder, data)
+    references = set(chunk.references())
+    assert chunk.primary_keys() == [record_data[0] for record_data in data], 'Primary keys differ'
+    for record_data, sql in zip(data, chunk.sql_values()):
+        expected = legacy_populate_record('orders', fields, table_references, record_data)
+        assert sql == expected['record'], 'Encoding differs for row %s:\n%s\n%s' % (record_data[0], expected['record'], sql)
+        for reference in expected['references'].items():
+            assert not reference[1] or reference in references, 'Reference %s:%s is missing' % reference
+
+    legacy = min(timeit.repeat(
+        lambda: [legacy_populate_record('orders', fields, table_references, record_data) for record_data in data],
+        number=1, repeat=5
+    ))
+    encoder = min(timeit.repeat(
+        lambda: list(RecordChunk(reader.encoder, data).sql_values()),
+        number=1, repeat=5
+    ))
+
+    # both are measured from before the rows are fetched (generated), with whatever each keeps per chunk
+    tracemalloc.start()
+    fetched = random_rows(rows)
+    records = [legacy_populate_record('orders', fields, table_references, record_data) for record_data in fetched]
+    del fetched
+    legacy_memory = tracemalloc.get_traced_memory()[0]
+    del records
+    tracemalloc.stop()
+    tracemalloc.start()
+    chunk = RecordChunk(reader.encoder, random_rows(rows))
+    chunk_memory = tracemalloc.get_traced_memory()[0]
+    del chunk
+    tracemalloc.stop()
+
+    print('rows:            %d (output identical)' % (rows,))
+    print('populate_record: %.3fs, %d rows/s, %d KB held per chunk' % (legacy, rows / legacy, legacy_memory / 1024))
+    print('RecordEncoder:   %.3fs, %d rows/s, %d KB held per chunk' % (encoder, rows / encoder, chunk_memory / 1024))
+    print('speedup:         %.2fx' % (legacy / encoder,))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,265 @@
+import os
+import sys
+import json
+import time
+import pickle
+import random
+import resource
+import datetime
+import subprocess
+from getopt import getopt
+from tempfile import TemporaryDirectory
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks.standins import Connection, connector, counting_redis, SCHEMA_FINGERPRINT
+
+# python3 -m benchmarks.slicing [--rows=N] [--workers=N] [--cupboard=memory|redis]
+#                               [--scenarios=a,b] [--save=file] [--compare=file] [--tolerance=0.2]
+#
+# runs SlicingMachine end to end on synthetic schemas against sqlite stand-ins for MySQL
+# and the in-process cupboard or fakeredis, every scenario in its own process (for peak RSS);
+# reports rows/s per stage, peak RSS and Redis round trips, --compare fails on regressions
+
+SQLITE_TYPES = {'int': 'INTEGER', 'bigint': 'INTEGER', 'decimal': 'REAL', 'varchar': 'TEXT', 'text': 'TEXT', 'datetime': 'TEXT'}
+STAGES = ('fetch', 'encode', 'persist', 'cupboard', 'references')
+
+def text(generator, length):
+    return ''.join(generator.choice('abcdefghij "\'\\\n\t') for _ in range(length))
+
+def timestamp(generator):
+    return str(datetime.datetime(2017, 1, 1) + datetime.timedelta(seconds=generator.randint(0, 10 ** 8)))
+
+# every scenario returns tables ({name: (columns, references, row count, row factory)}) and schema.yml content
+def fk_chain(rows):
+    tables = {'level1': ([('id', 'int', 'NO'), ('name', 'varchar', 'NO')], {}, rows, lambda g, i: (i, text(g, 20)))}
+    for level in range(2, 6):
+        tables['level%d' % (level,)] = (
+            [('id', 'int', 'NO'), ('parent_id', 'int', 'YES'), ('name', 'varchar', 'NO')],
+            {'parent_id': 'level%d' % (level - 1,)},
+            rows,
+            lambda g, i: (i, g.choice([None, g.randint(1, rows)]), text(g, 20))
+        )
+    schema = {'rules': {'even': {'where': '%table_name%.`id` %% 2 = 0'}}, 'tables': dict(
+        [('level%d' % (level,), {'rule': 'upon_request'}) for level in range(1, 5)] + [('level5', {'rule': 'even'})]
+    )}
+    return tables, schema
+
+def wide_text(rows):
+    columns = [('id', 'int', 'NO')] + \
+        [('title%d' % (i,), 'varchar', 'NO') for i in range(10)] + \
+        [('body%d' % (i,), 'text', 'YES') for i in range(10)] + \
+        [('amount%d' % (i,), 'decimal', 'YES') for i in range(5)] + \
+        [('updated%d' % (i,), 'datetime', 'NO') for i in range(5)]
+    row = lambda g, i: (i,) + \
+        tuple([text(g, 30) for _ in range(10)]) + \
+        tuple([g.choice([None, text(g, 200)]) for _ in range(10)]) + \
+        tuple([g.choice([None, g.random() * 1000]) for _ in range(5)]) + \
+        tuple([timestamp(g) for _ in range(5)])
+    return {'documents': (columns, {}, rows // 4, row)}, {'rules': {'full': {'where': '1 = 1'}}, 'tables': {'documents': {'rule': 'full'}}}
+
+def join(rows, strategy):
+    tables = {
+        'users': ([('id', 'int', 'NO'), ('email', 'varchar', 'NO')], {}, rows, lambda g, i: (i, 'user%d@example.com' % (i,))),
+        'orders': (
+            [('id', 'int', 'NO'), ('user_id', 'int', 'NO'), ('created_at', 'datetime', 'NO')],
+            {'user_id': 'users'}, rows, lambda g, i: (i, g.randint(1, rows), timestamp(g))
+        ),
+        'order_items': (
+            [('id', 'int', 'NO'), ('order_id', 'int', 'NO'), ('price', 'decimal', 'NO')],
+            {'order_id': 'orders'}, rows * 3, lambda g, i: (i, g.randint(1, rows), g.random() * 100)
+        ),
+    }
+    schema = {'rules': {'quarter': {'where': '%table_name%.`id` %% 4 = 0'}}, 'tables': {
+        'users': {'rule': 'upon_request'},
+        'orders': {'rule': 'quarter'},
+        'order_items': {'rule': 'join', 'table': 'orders', 'reference': 'order_id', 'strategy': strategy},
+    }}
+    return tables, schema
+
+def masks(rows):
+    columns = [('id', 'int', 'NO'), ('email', 'varchar', 'NO'), ('firstname', 'varchar', 'NO'), ('lastname', 'varchar', 'NO')]
+    row = lambda g, i: (i, 'user%d@example.com' % (i,), text(g, 10), text(g, 12))
+    return {'users': (columns, {}, rows, row)}, {'rules': {'full': {'where': '1 = 1'}}, 'tables': {'users': {
+        'rule': 'full',
+        # sqlite syntax, as the stand-in runs the queries
+        'mask': {'email': "'nobody+' || id || '@example.com'", 'firstname': "'John'", 'lastname': "'Doe'"},
+    }}}
+
+SCENARIOS = {
+    'fk_chain': fk_chain,
+    'wide_text': wide_text,
+    'join_in_list': lambda rows: join(rows, 'in_list'),
+    'join_semijoin': lambda rows: join(rows, 'semijoin'),
+    'masks': masks,
+}
+
+def create_databases(directory, tables):
+    source, target = os.path.join(directory, 'source.db'), os.path.join(directory, 'target.db')
+    generator = random.Random(42)
+    metadata = dict()
+    for path in (source, target):
+        connection = Connection(path)
+        connection.db.execute('PRAGMA journal_mode=WAL')
+        for table, (columns, references, count, row) in tables.items():
+            connection.db.execute('CREATE TABLE `%s` (%s)' % (table, ', '.join(
+                ['`%s` %s%s' % (name, SQLITE_TYPES[type], ' PRIMARY KEY' if name == 'id' else '',) for name, type, _ in columns]
+            ),))
+            if path == source:
+                connection.db.executemany(
+                    'INSERT INTO `%s` VALUES (%s)' % (table, ','.join(['?'] * len(columns)),),
+                    (row(generator, index) for index in range(1, count + 1))
+                )
+        connection.commit()
+        connection.close()
+
+    for table, (columns, references, _, _) in tables.items():
+        fields = {'__primary__': 'id', '__order__': [name for name, _, _ in columns]}
+        for name, type, null in columns:
+            fields[name] = {'name': name, 'index': 'PRI' if name == 'id' else '', 'type': type, 'null': null}
+        metadata[table] = {
+            'fields': fields,
+            'refs': dict([(field, (parent, 'id',)) for field, parent in references.items()]),
+            'create_sql': '',
+        }
+    return source, target, metadata
+
+def run(scenario, rows, workers, cupboard_backend):
+    from datasource import DataRegistry
+    from slicer import SlicingMachine
+    from scheduler import TableScheduler
+    from metrics import metrics
+    import cupboard
+
+    tables, schema = SCENARIOS[scenario](rows)
+    with TemporaryDirectory() as directory:
+        source, target, metadata = create_databases(directory, tables)
+        # the registry is loaded from a metadata cache matching the stand-in's schema fingerprint
+        cache_file = os.path.join(directory, 'metadata.pickle')
+        with open(cache_file, 'wb') as cache:
+            pickle.dump({
+                'version': DataRegistry._DataRegistry__CACHE_VERSION,
+                'database': 'benchmark',
+                'fingerprint': '/'.join(SCHEMA_FINGERPRINT),
+                'tables': set(metadata),
+                'metadata': metadata,
+                'routines': [],
+            }, cache)
+        schema_file = os.path.join(directory, 'schema.yml')
+        with open(schema_file, 'w') as schema_data:
+            json.dump(schema, schema_data)
+
+        if cupboard_backend == 'redis':
+            cupboard.redis.StrictRedis = counting_redis()
+            # the same as run.py sets up
+            shelves = cupboard.ShelfFilter(cupboard.RedisCupboard(True))
+        else:
+            shelves = cupboard.MemoryCupboard()
+
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        started_at = time.time()
+        try:
+            read_connection = Connection(source)
+            registry = DataRegistry('benchmark', schema_file, read_connection, connector(source), workers, cache_file)
+            machine = SlicingMachine(registry, connector(source), connector(target), shelves, {}, {}, workers, split_rows=rows)
+            ordered = TableScheduler(registry, read_connection, 'benchmark').order(registry.tables, workers)
+            read_connection.close()
+            tasks = [task for table in ordered for task in machine.split_table(table)]
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(lambda task: machine.slice_table(*task), tasks))
+            machine.persist_references()
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        duration = time.time() - started_at
+
+        connection = Connection(target)
+        copied = dict([(table, connection.db.execute('SELECT COUNT(*) FROM `%s`' % (table,)).fetchone()[0]) for table in tables])
+        for table, (_, references, _, _) in tables.items():
+            for field, parent in references.items():
+                dangling = connection.db.execute(
+                    'SELECT COUNT(*) FROM `%s` c LEFT JOIN `%s` p ON p.id = c.`%s` WHERE c.`%s` IS NOT NULL AND p.id IS NULL' %
+                    (table, parent, field, field,)
+                ).fetchone()[0]
+                assert not dangling, '%d rows of "%s" reference missing "%s" records' % (dangling, table, parent,)
+        connection.close()
+
+    report = metrics.report()
+    stages = dict()
+    for stage in STAGES:
+        seconds = sum([phases[stage]['time'] for phases in report['tables'].values() if stage in phases])
+        stage_rows = sum([phases[stage]['rows'] for phases in report['tables'].values() if stage in phases])
+        stages[stage] = {'time': round(seconds, 3), 'rows': stage_rows, 'rows_per_second': round(stage_rows / seconds) if seconds else 0}
+    return {
+        'rows': sum(copied.values()),
+        'time': round(duration, 3),
+        'rows_per_second': round(sum(copied.values()) / duration),
+        'stages': stages,
+        'reference_iterations': len(report['reference_iterations']),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'redis_round_trips': cupboard.redis.StrictRedis.round_trips if cupboard_backend == 'redis' else 0,
+    }
+
+def regressions(results, baseline, tolerance):
+    found = list()
+    for scenario, result in results.items():
+        if scenario not in baseline:
+            continue
+        expected = baseline[scenario]
+        checks = [('rows/s', result['rows_per_second'], expected['rows_per_second'], True)] + [
+            ('%s rows/s' % (stage,), result['stages'][stage]['rows_per_second'], expected['stages'][stage]['rows_per_second'], True)
+            for stage in STAGES if expected['stages'][stage]['rows_per_second']
+        ] + [
+            ('peak RSS MB', result['peak_rss_mb'], expected['peak_rss_mb'], False),
+            ('Redis round trips', result['redis_round_trips'], expected['redis_round_trips'], False),
+        ]
+        for name, value, reference, higher_is_better in checks:
+            if higher_is_better and value < reference * (1 - tolerance) \
+                    or not higher_is_better and value > reference * (1 + tolerance):
+                found.append('%s: %s %s (baseline %s)' % (scenario, name, value, reference,))
+    return found
+
+def main(argv):
+    opts, _ = getopt(argv, '', ['rows=', 'workers=', 'cupboard=', 'scenarios=', 'save=', 'compare=', 'tolerance=', 'run='])
+    options = dict(opts)
+    rows = int(options.get('--rows', 20000))
+    workers = int(options.get('--workers', 4))
+    cupboard_backend = options.get('--cupboard', 'memory')
+
+    if '--run' in options:
+        print(json.dumps(run(options['--run'], rows, workers, cupboard_backend)))
+        return 0
+
+    scenarios = options['--scenarios'].split(',') if '--scenarios' in options else list(SCENARIOS)
+    assert not set(scenarios) - set(SCENARIOS), 'Unknown scenarios: %s' % (', '.join(set(scenarios) - set(SCENARIOS)),)
+    results = dict()
+    print('%-14s %9s %8s %10s %10s %10s %10s %10s %8s %7s' % (
+        'scenario', 'rows', 'rows/s', 'fetch/s', 'encode/s', 'persist/s', 'cupboard/s', 'refs/s', 'RSS MB', 'Redis',
+    ))
+    for scenario in scenarios:
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.slicing', '--run=' + scenario, '--rows=%d' % (rows,),
+             '--workers=%d' % (workers,), '--cupboard=' + cupboard_backend],
+            stdout=subprocess.PIPE, check=True, universal_newlines=True
+        ).stdout
+        result = results[scenario] = json.loads(output.strip().split('\n')[-1])
+        print('%-14s %9d %8d %10d %10d %10d %10d %10d %8.1f %7d' % (
+            (scenario, result['rows'], result['rows_per_second']) +
+            tuple([result['stages'][stage]['rows_per_second'] for stage in STAGES]) +
+            (result['peak_rss_mb'], result['redis_round_trips'])
+        ))
+
+    settings = {'rows': rows, 'workers': workers, 'cupboard': cupboard_backend}
+    if '--save' in options:
+        with open(options['--save'], 'w') as saved:
+            json.dump({'settings': settings, 'results': results}, saved, indent=2, sort_keys=True)
+    if '--compare' in options:
+        with open(options['--compare']) as saved:
+            baseline = json.load(saved)
+        assert baseline['settings'] == settings, 'Baseline was run with other settings: %s' % (baseline['settings'],)
+        found = regressions(results, baseline['results'], float(options.get('--tolerance', 0.2)))
+        for regression in found:
+            print('regression:', regression)
+        return 1 if found else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
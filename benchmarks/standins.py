@@ -0,0 +1,153 @@
+import re
+import sqlite3
+import threading
+
+# sqlite backed stand-ins for MySQL connections (as far as the slicer uses them)
+# and a Redis client counting round trips, for local benchmarks only
+
+SCHEMA_FINGERPRINT = ('benchmark',) * 5
+TABLE_ROWS_QUERY = re.compile(r'SELECT t?\.?TABLE_ROWS FROM information_schema\.TABLES.*TABLE_NAME = (\S+)', re.S)
+TABLE_LIST_QUERY = re.compile(r'SELECT t\.TABLE_NAME, t\.TABLE_ROWS\s+FROM information_schema\.TABLES', re.S)
+MYSQL_STRING = re.compile(r'"((?:[^"\\]|\\.)*)"', re.S)
+MYSQL_ESCAPE = re.compile(r'\\(.)', re.S)
+
+# double quoted strings with backslash escapes (as the encoder writes them) to sqlite literals
+def sqlite_strings(sql):
+    return MYSQL_STRING.sub(lambda match: literal(MYSQL_ESCAPE.sub(r'\1', match.group(1))), sql)
+
+def literal(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    return "'" + str(value).replace("'", "''") + "'"
+
+class Cursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+        self.rows = []
+        self.position = 0
+
+    def execute(self, sql, args = None):
+        # same as MySQLdb: parameters are interpolated only when given
+        if args is not None:
+            sql = sql % tuple([literal(arg) for arg in args])
+        self.connection.statements += 1
+        if sql.startswith('SET '):
+            return 0
+        if 'CRC32' in sql:
+            return self.__result([SCHEMA_FINGERPRINT])
+        if TABLE_LIST_QUERY.search(sql):
+            tables = self.connection.db.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+            return self.__result([(table, self.__count(table),) for table, in tables])
+        match = TABLE_ROWS_QUERY.search(sql)
+        if match:
+            return self.__result([(self.__count(match.group(1).strip("'")),)])
+        if sql.startswith('EXPLAIN '):
+            rows = self.connection.db.execute('SELECT COUNT(*) FROM (%s)' % (sql[8:],)).fetchone()[0]
+            return self.__result([(rows, 100.0,)], ('rows', 'filtered',))
+        if sql.startswith('INSERT '):
+            sql = sqlite_strings(sql.replace('INSERT IGNORE', 'INSERT OR IGNORE'))
+        cursor = self.connection.db.execute(sql)
+        self.description = cursor.description
+        self.rows = cursor.fetchall()
+        self.position = 0
+        return len(self.rows) if self.rows else max(cursor.rowcount, 0)
+
+    def fetchall(self):
+        rows = self.rows[self.position:]
+        self.position = len(self.rows)
+        return tuple(rows)
+
+    def fetchone(self):
+        row = self.rows[self.position] if self.position < len(self.rows) else None
+        self.position += 1
+        return row
+
+    def fetchmany(self, size):
+        rows = self.rows[self.position:self.position + size]
+        self.position += len(rows)
+        return tuple(rows)
+
+    def close(self):
+        pass
+
+    def __count(self, table):
+        return self.connection.db.execute('SELECT COUNT(*) FROM `%s`' % (table,)).fetchone()[0]
+
+    def __result(self, rows, columns = ()):
+        self.description = tuple([(column,) for column in columns]) or None
+        self.rows = rows
+        self.position = 0
+        return len(rows)
+
+class Connection:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, timeout=600, check_same_thread=False)
+        self.statements = 0
+
+    def cursor(self, cursor_class = None):
+        return Cursor(self)
+
+    def query(self, sql):
+        Cursor(self).execute(sql)
+
+    def literal(self, value):
+        return literal(value).encode('utf-8')
+
+    def autocommit(self, enabled):
+        pass
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+    def errno(self):
+        return 0
+
+    def error(self):
+        return ''
+
+    def close(self):
+        self.db.close()
+
+def connector(path):
+    return lambda: Connection(path)
+
+# returns a client class sharing one fake server, as StrictRedis(host, port, db) is called by the cupboard
+def counting_redis():
+    import fakeredis
+    server = fakeredis.FakeServer()
+
+    class CountingRedis(fakeredis.FakeStrictRedis):
+        lock = threading.Lock()
+        round_trips = 0
+
+        def __init__(self, host = None, port = None, db = None):
+            super().__init__(server=server)
+
+        def execute_command(self, *args, **options):
+            self.count()
+            return super().execute_command(*args, **options)
+
+        def pipeline(self, *args, **options):
+            pipe = super().pipeline(*args, **options)
+            execute = pipe.execute
+            def counted_execute(*args, **options):
+                # scripts missing in the server cache are loaded within the same call
+                self.count()
+                return execute(*args, **options)
+            pipe.execute = counted_execute
+            return pipe
+
+        @classmethod
+        def count(cls):
+            with cls.lock:
+                cls.round_trips += 1
+
+    return CountingRedis
@@ -8,19 +8,51 @@ class Configuration:
         assert isfile(config_file), 'Configuration file is missing.'
 
         with open('config.yml') as config_file:
-            self.__config = yaml.load(config_file)
+            self.__config = yaml.safe_load(config_file)
 
-        for parameter in ['mysql', 'redis', 'max_workers']:
+        for parameter in ['mysql', 'max_workers']:
             assert parameter in self.__config, 'Configuration for "%s" is missing.' % (parameter,)
 
+        assert self.get_cupboard_backend() in ['redis', 'memory'], \
+            'Unknown cupboard "%s".' % (self.get_cupboard_backend(),)
+        if self.get_cupboard_backend() == 'redis':
+            assert 'redis' in self.__config, 'Configuration for "redis" is missing.'
+
     def get_mysql_parameters(self, connection_name):
         assert connection_name in self.__config['mysql'], \
             'Connection settings "%s" not found.' % (connection_name,)
 
         return self.__config['mysql'][connection_name]
 
+    def get_cupboard_backend(self):
+        return self.__config.get('cupboard', 'redis')
+
     def get_redis_parameters(self):
         return self.__config['redis']
 
+    def get_shelf_filter_parameters(self):
+        return dict(self.__config.get('shelf_filter') or {})
+
     def get_max_workers(self):
         return self.__config['max_workers']
+
+    def get_metadata_cache_dir(self):
+        return self.__config.get('metadata_cache')
+
+    def get_slicer_parameters(self):
+        return self.__config.get('slicer') or {}
+
+    def get_pool_parameters(self):
+        return dict(self.__config.get('pool') or {})
+
+    def get_async_parameters(self):
+        return self.__config.get('async_engine') or {}
+
+    def get_planner_parameters(self):
+        return self.__config.get('planner') or {}
+
+    def get_reader_parameters(self):
+        return self.__config.get('reader') or {}
+
+    def get_writer_parameters(self):
+        return self.__config.get('writer') or {}
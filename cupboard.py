@@ -1,43 +1,451 @@
+import json
+import time
 import redis
+import threading
+from array import array
+from collections import OrderedDict
+from bisect import bisect_left
+from metrics import metrics
 
-class RedisCupboard:
-    def __init__(self, cleanup, host='localhost', port=6379, db=0):
+class Cupboard:
+    def put_on_shelf(self, table, *keys):
+        raise NotImplementedError()
+
+    def put_on_reference_shelf(self, references):
+        raise NotImplementedError()
+
+    def has_pending_references(self):
+        raise NotImplementedError()
+
+    def get_all_references(self):
+        raise NotImplementedError()
+
+    def release_references(self, table):
+        raise NotImplementedError()
+
+    def clear_shelf(self, table):
+        raise NotImplementedError()
+
+    def remove_from_shelf(self, table, *keys):
+        raise NotImplementedError()
+
+    def save_checkpoint(self, table, task, state):
+        raise NotImplementedError()
+
+    def load_checkpoint(self, table, task):
+        raise NotImplementedError()
+
+    def clear_checkpoints(self, table, *keep):
+        raise NotImplementedError()
+
+class RedisCupboard(Cupboard):
+    # adds keys missing on the records shelf to the references shelf in one round trip
+    __REFERENCE_SCRIPT = """
+        local added = 0
+        for i = 2, #ARGV do
+            if redis.call('SISMEMBER', KEYS[1], ARGV[i]) == 0 then
+                added = added + redis.call('SADD', KEYS[2], ARGV[i])
+            end
+        end
+        if added > 0 then
+            redis.call('SADD', KEYS[3], ARGV[1])
+        end
+        return added
+    """
+
+    def __init__(self, cleanup, host='localhost', port=6379, db=0, batch_size=10000):
         self.redis = redis.StrictRedis(host, port, db)
+        self.batch_size = batch_size
+        self.reference_script = self.redis.register_script(self.__REFERENCE_SCRIPT)
         if cleanup:
             self.redis.flushdb()
 
+    # time, keys and commands sent are accounted to the table in "cupboard" phase
     def put_on_shelf(self, table, *keys):
+        started_at = time.time()
         records_heap = 'table:' + table
         tables_heap = 'tables'
-        self.redis.sadd(tables_heap, table)
-        self.redis.sadd(records_heap, *keys)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.sadd(tables_heap, table)
+        for offset in range(0, len(keys), self.batch_size):
+            pipe.sadd(records_heap, *keys[offset:offset+self.batch_size])
+        commands = len(pipe)
+        pipe.execute()
+        metrics.add(table, 'cupboard', time.time() - started_at, len(keys), calls=commands)
 
     def put_on_reference_shelf(self, references):
+        started_at = time.time()
         reftables_heap = 'reftables'
-        for reference in references:
-            table, primary_key = reference
+        tables = dict()
+        for table, primary_key in references:
+            tables.setdefault(table, list()).append(primary_key)
+
+        pipe = self.redis.pipeline(transaction=False)
+        for table, primary_keys in tables.items():
             references_heap = 'ref:' + table
             records_heap = 'table:' + table
-            if not self.redis.sismember(records_heap, primary_key):
-                self.redis.sadd(reftables_heap, table)
-                self.redis.sadd(references_heap, primary_key)
+            for offset in range(0, len(primary_keys), self.batch_size):
+                self.reference_script(
+                    keys=[records_heap, references_heap, reftables_heap],
+                    args=[table] + primary_keys[offset:offset+self.batch_size],
+                    client=pipe
+                )
+        pipe.execute()
+        account_references(
+            dict([(table, len(primary_keys)) for table, primary_keys in tables.items()]),
+            time.time() - started_at,
+            lambda count: -(-count // self.batch_size)
+        )
 
     def has_pending_references(self):
         reftables_heap = 'reftables'
-        return self.redis.scard(reftables_heap) > 0
+        inflight_tables_heap = 'inflighttables'
+        return self.redis.scard(reftables_heap) > 0 or self.redis.scard(inflight_tables_heap) > 0
 
     def get_all_references(self):
         reftables_heap = 'reftables'
-        tables = self.redis.smembers(reftables_heap)
+        inflight_tables_heap = 'inflighttables'
+        # references handed out are kept aside until released, so the ones
+        # of an interrupted run are handed out again after resume
+        tables = self.redis.smembers(reftables_heap) | self.redis.smembers(inflight_tables_heap)
         for table in tables:
-            references_heap = 'ref:' + table.decode('utf-8')
-            records_heap = 'table:' + table.decode('utf-8')
-            references = self.redis.sdiff(references_heap, records_heap)
+            table = table.decode('utf-8')
+            references_heap = 'ref:' + table
+            inflight_heap = 'inflight:' + table
+            records_heap = 'table:' + table
+            pipe = self.redis.pipeline()
+            pipe.sunionstore(inflight_heap, inflight_heap, references_heap)
+            pipe.delete(references_heap)
+            pipe.srem(reftables_heap, table)
+            pipe.sadd(inflight_tables_heap, table)
+            pipe.sdiff(inflight_heap, records_heap)
+            started_at = time.time()
+            references = pipe.execute()[-1]
+            metrics.add(table, 'cupboard', time.time() - started_at, len(references), calls=len(pipe))
             print('     ', references_heap, records_heap, len(references))
-            self.redis.delete(references_heap)
-            self.redis.srem(reftables_heap, table.decode('utf-8'))
             yield (table, references,)
 
+    def release_references(self, table):
+        inflight_tables_heap = 'inflighttables'
+        pipe = self.redis.pipeline()
+        pipe.delete('inflight:' + table)
+        pipe.srem(inflight_tables_heap, table)
+        pipe.execute()
+
     def clear_shelf(self, table):
         records_heap = 'table:' + table
         self.redis.delete(records_heap)
+
+    def remove_from_shelf(self, table, *keys):
+        records_heap = 'table:' + table
+        pipe = self.redis.pipeline(transaction=False)
+        for offset in range(0, len(keys), self.batch_size):
+            pipe.srem(records_heap, *keys[offset:offset+self.batch_size])
+        pipe.execute()
+
+    def save_checkpoint(self, table, task, state):
+        self.redis.hset('checkpoint:' + table, task, json.dumps(state))
+
+    def load_checkpoint(self, table, task):
+        state = self.redis.hget('checkpoint:' + table, task)
+        return json.loads(state.decode('utf-8')) if state else None
+
+    def clear_checkpoints(self, table, *keep):
+        tasks = [task for task in self.redis.hkeys('checkpoint:' + table) if task.decode('utf-8') not in keep]
+        if tasks:
+            self.redis.hdel('checkpoint:' + table, *tasks)
+
+class MemoryCupboard(Cupboard):
+    def __init__(self, cleanup = True):
+        self.lock = threading.Lock()
+        self.shelves = dict()
+        self.references = dict()
+        self.checkpoints = dict()
+
+    def put_on_shelf(self, table, *keys):
+        started_at = time.time()
+        with self.lock:
+            if table not in self.shelves:
+                self.shelves[table] = IntegerSet()
+            self.shelves[table].update(keys)
+        metrics.add(table, 'cupboard', time.time() - started_at, len(keys))
+
+    def put_on_reference_shelf(self, references):
+        started_at = time.time()
+        counts = dict()
+        with self.lock:
+            for table, primary_key in references:
+                counts[table] = counts.get(table, 0) + 1
+                if table in self.shelves and primary_key in self.shelves[table]:
+                    continue
+                if table not in self.references:
+                    self.references[table] = IntegerSet()
+                self.references[table].add(primary_key)
+        account_references(counts, time.time() - started_at, lambda count: 1)
+
+    def has_pending_references(self):
+        with self.lock:
+            return any(len(references) for references in self.references.values())
+
+    def get_all_references(self):
+        with self.lock:
+            tables = list(self.references)
+        for table in tables:
+            with self.lock:
+                references = self.references.pop(table, IntegerSet())
+                if table in self.shelves:
+                    references = references.difference(self.shelves[table])
+                references = list(references)
+            print('     ', 'ref:' + table, 'table:' + table, len(references))
+            yield (table, references,)
+
+    def release_references(self, table):
+        pass
+
+    def clear_shelf(self, table):
+        with self.lock:
+            self.shelves.pop(table, None)
+
+    def remove_from_shelf(self, table, *keys):
+        removed = IntegerSet()
+        removed.update(keys)
+        with self.lock:
+            if table in self.shelves:
+                self.shelves[table] = self.shelves[table].difference(removed)
+
+    def save_checkpoint(self, table, task, state):
+        with self.lock:
+            self.checkpoints[(table, task,)] = dict(state)
+
+    def load_checkpoint(self, table, task):
+        with self.lock:
+            return self.checkpoints.get((table, task,))
+
+    def clear_checkpoints(self, table, *keep):
+        with self.lock:
+            for checkpoint in [checkpoint for checkpoint in self.checkpoints if checkpoint[0] == table and checkpoint[1] not in keep]:
+                del self.checkpoints[checkpoint]
+
+# answers "already in the cupboard" in process for hot referenced keys (e.g. a handful of cities
+# referenced by every user), so they aren't sent to Redis over and over; a key is dropped only when
+# it is certainly on one of the shelves, so lookups go to an LRU of keys already sent;
+# keys enter it on their second sighting (recorded by a Bloom filter), so keys referenced once don't
+# evict hot ones; both are shared by all tables, so memory doesn't grow with the number of tables
+class ShelfFilter(Cupboard):
+    def __init__(self, cupboard, cached_keys = 100000, bloom_bits = 1 << 23, hashes = 4):
+        self.cupboard = cupboard
+        self.lock = threading.Lock()
+        self.filter = KeyFilter(cached_keys, bloom_bits, hashes)
+        # bumped whenever keys of a table may be gone from its shelf
+        self.generations = dict()
+
+    def put_on_shelf(self, table, *keys):
+        self.cupboard.put_on_shelf(table, *keys)
+
+    def put_on_reference_shelf(self, references):
+        pending = list()
+        counts = dict()
+        generations = dict()
+        with self.lock:
+            for table, primary_key in references:
+                generations[table] = self.generations.get(table, 0)
+                lookups, hits = counts.get(table, (0, 0,))
+                if self.filter.cached((table, primary_key,)):
+                    counts[table] = (lookups + 1, hits + 1,)
+                else:
+                    counts[table] = (lookups + 1, hits,)
+                    pending.append((table, primary_key,))
+        # keys are remembered only once they are really sent, unless the shelf was cleared meanwhile
+        if pending:
+            self.cupboard.put_on_reference_shelf(pending)
+            with self.lock:
+                for table, primary_key in pending:
+                    if self.generations.get(table, 0) == generations[table]:
+                        self.filter.admit((table, primary_key,))
+        for table, (lookups, hits) in counts.items():
+            metrics.add_filter(table, lookups, hits)
+
+    def has_pending_references(self):
+        return self.cupboard.has_pending_references()
+
+    def get_all_references(self):
+        return self.cupboard.get_all_references()
+
+    def release_references(self, table):
+        self.cupboard.release_references(table)
+
+    def clear_shelf(self, table):
+        self.__forget(table)
+        self.cupboard.clear_shelf(table)
+
+    def remove_from_shelf(self, table, *keys):
+        self.__forget(table)
+        self.cupboard.remove_from_shelf(table, *keys)
+
+    def __forget(self, table):
+        with self.lock:
+            self.generations[table] = self.generations.get(table, 0) + 1
+            self.filter.forget(lambda key: key[0] == table)
+
+    def save_checkpoint(self, table, task, state):
+        self.cupboard.save_checkpoint(table, task, state)
+
+    def load_checkpoint(self, table, task):
+        return self.cupboard.load_checkpoint(table, task)
+
+    def clear_checkpoints(self, table, *keep):
+        self.cupboard.clear_checkpoints(table, *keep)
+
+class KeyFilter:
+    def __init__(self, cached_keys, bloom_bits, hashes):
+        self.cached_keys = cached_keys
+        self.bloom_bits = bloom_bits
+        self.hashes = hashes
+        self.keys = OrderedDict()
+        self.bloom = bytearray(bloom_bits >> 3)
+        self.bloom_keys = 0
+
+    def cached(self, key):
+        if key not in self.keys:
+            return False
+        self.keys.move_to_end(key)
+        return True
+
+    def forget(self, matches):
+        for key in [key for key in self.keys if matches(key)]:
+            del self.keys[key]
+
+    def admit(self, key):
+        if key in self.keys:
+            return
+        if not self.__seen(key):
+            return
+        self.keys[key] = True
+        if len(self.keys) > self.cached_keys:
+            self.keys.popitem(last=False)
+
+    # records the key and tells whether it was (probably) recorded before;
+    # the filter starts over once full enough for false positives to grow (~2% with 4 hashes)
+    def __seen(self, key):
+        if self.bloom_keys >= self.bloom_bits >> 3:
+            self.bloom = bytearray(self.bloom_bits >> 3)
+            self.bloom_keys = 0
+        hashed = hash((key, 'bloom',))
+        step = (hashed >> 32) | 1
+        seen = True
+        for i in range(self.hashes):
+            bit = (hashed + i * step) % self.bloom_bits
+            if not self.bloom[bit >> 3] >> (bit & 7) & 1:
+                seen = False
+                self.bloom[bit >> 3] |= 1 << (bit & 7)
+        if not seen:
+            self.bloom_keys += 1
+        return seen
+
+# time of a call spanning several referenced tables is shared by their key counts
+def account_references(counts, seconds, calls):
+    keys = sum(counts.values())
+    for table, count in counts.items():
+        metrics.add(table, 'cupboard', seconds * count / keys, count, calls=calls(count))
+
+# roaring-style set of integer keys: keys are grouped by their high bits into containers
+# of 65536 values, each kept as a sorted array('H') while sparse and switched to
+# an 8KB bitmap once dense; non-integer keys go to a plain set
+class IntegerSet:
+    __ARRAY_LIMIT = 4096
+
+    def __init__(self):
+        self.containers = dict()
+        self.others = set()
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def __contains__(self, key):
+        if not isinstance(key, int):
+            return key in self.others
+        container = self.containers.get(key >> 16)
+        if container is None:
+            return False
+        return self.__container_contains(container, key & 0xFFFF)
+
+    def __iter__(self):
+        for high in sorted(self.containers):
+            yield from self.__container_keys(self.containers[high], high << 16)
+        yield from self.others
+
+    def add(self, key):
+        if not isinstance(key, int):
+            if key not in self.others:
+                self.others.add(key)
+                self.length += 1
+            return
+        high, low = key >> 16, key & 0xFFFF
+        container = self.containers.get(high)
+        if container is None:
+            self.containers[high] = array('H', (low,))
+        elif isinstance(container, bytearray):
+            if container[low >> 3] >> (low & 7) & 1:
+                return
+            container[low >> 3] |= 1 << (low & 7)
+        else:
+            position = bisect_left(container, low)
+            if position < len(container) and container[position] == low:
+                return
+            container.insert(position, low)
+            if len(container) > self.__ARRAY_LIMIT:
+                self.containers[high] = self.__to_bitmap(container)
+        self.length += 1
+
+    def update(self, keys):
+        for key in keys:
+            self.add(key)
+
+    def difference(self, other):
+        result = IntegerSet()
+        for high, container in self.containers.items():
+            other_container = other.containers.get(high)
+            if other_container is None:
+                result.containers[high] = container[:] if not isinstance(container, bytearray) else bytearray(container)
+                result.length += self.__container_length(container)
+                continue
+            base = high << 16
+            for key in self.__container_keys(container, base):
+                if not self.__container_contains(other_container, key & 0xFFFF):
+                    result.add(key)
+        for key in self.others - other.others:
+            result.add(key)
+        return result
+
+    @staticmethod
+    def __container_contains(container, low):
+        if isinstance(container, bytearray):
+            return bool(container[low >> 3] >> (low & 7) & 1)
+        position = bisect_left(container, low)
+        return position < len(container) and container[position] == low
+
+    @staticmethod
+    def __container_length(container):
+        if isinstance(container, bytearray):
+            return sum(bin(byte).count('1') for byte in container)
+        return len(container)
+
+    @staticmethod
+    def __container_keys(container, base):
+        if isinstance(container, bytearray):
+            for index, byte in enumerate(container):
+                if byte:
+                    for bit in range(8):
+                        if byte >> bit & 1:
+                            yield base | index << 3 | bit
+        else:
+            for low in container:
+                yield base | low
+
+    @staticmethod
+    def __to_bitmap(container):
+        bitmap = bytearray(8192)
+        for low in container:
+            bitmap[low >> 3] |= 1 << (low & 7)
+        return bitmap
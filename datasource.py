@@ -1,50 +1,172 @@
 import MySQLdb
+import MySQLdb.cursors
 import yaml
 import re
+import json
+from concurrent.futures import ThreadPoolExecutor
+import pickle
 from copy import deepcopy
-from os.path import isfile
+from os import makedirs, replace
+from os.path import isfile, dirname
+
+PAGINATION_MODES = ('keyset', 'offset',)
+INTEGER_TYPES = ('tinyint', 'smallint', 'mediumint', 'int', 'bigint',)
+JOIN_STRATEGIES = ('auto', 'in_list', 'semijoin',)
 
 class DataRegistry:
     tables = None
     metadata = None
     routines = None
+    __CACHE_VERSION = 2
+
+    def __init__(self, db_name, schema_file, connection, connector = None, workers = 1, cache_file = None):
+        self.__connector = connector
+        self.__workers = workers
+        fingerprint = self.__schema_fingerprint(connection, db_name) if cache_file else None
+        if not (cache_file and self.__load_cache(cache_file, db_name, fingerprint)):
+            self.__load_metadata(connection, db_name)
+            if cache_file:
+                self.__save_cache(cache_file, db_name, fingerprint)
+        self.__schema_configuration = self.__load_schema_configuration(schema_file)
+        self.__table_readers = dict()
 
-    def __init__(self, db_name, schema_file, connection):
+    def __load_metadata(self, connection, db_name):
         self.tables = self.__load_table_list(connection)
-        self.metadata = dict(zip(self.tables, [
-            {
-                'fields': self.__load_fields(connection, db_name, table),
-                'refs': self.__load_references(connection, db_name, table),
-                'create_sql': self.__table_create_sql(connection, table),
-            } for table in self.tables
-        ]))
+        fields = self.__load_fields(connection, db_name)
+        references = self.__load_references(connection, db_name, fields)
+        create_sql = self.__load_create_sql(connection, [
+            'SHOW CREATE TABLE `%s`' % (table,) for table in self.tables
+        ])
+        self.metadata = dict()
+        for table in self.tables:
+            if table not in fields:
+                raise ValueError("Table '{}' has no fields".format(table))
+            self.metadata[table] = {
+                'fields': fields[table],
+                'refs': references.get(table, dict()),
+                'create_sql': create_sql['SHOW CREATE TABLE `%s`' % (table,)][1],
+            }
         self.routines = self.__load_routines(connection, db_name)
-        self.__schema_configuration = self.__load_schema_configuration(schema_file)
-        self.__table_readers = dict()
+
+    def __schema_fingerprint(self, connection, database):
+        # cheap checksums over schema objects; data changes don't affect any of them,
+        # while CREATE_TIME changes whenever a table gets rebuilt by ALTER TABLE
+        query = """
+            SELECT
+                (SELECT CONCAT(COUNT(*), ':', COALESCE(SUM(CRC32(CONCAT_WS('|',
+                        TABLE_NAME, TABLE_TYPE, ENGINE, CREATE_TIME, TABLE_COLLATION))), 0))
+                    FROM information_schema.TABLES WHERE TABLE_SCHEMA = %s),
+                (SELECT CONCAT(COUNT(*), ':', COALESCE(SUM(CRC32(CONCAT_WS('|',
+                        TABLE_NAME, COLUMN_NAME, ORDINAL_POSITION, COLUMN_TYPE, COLUMN_KEY, IS_NULLABLE, COLUMN_DEFAULT, EXTRA))), 0))
+                    FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = %s),
+                (SELECT CONCAT(COUNT(*), ':', COALESCE(SUM(CRC32(CONCAT_WS('|',
+                        TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX, COLUMN_NAME, NON_UNIQUE, INDEX_TYPE))), 0))
+                    FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = %s),
+                (SELECT CONCAT(COUNT(*), ':', COALESCE(SUM(CRC32(CONCAT_WS('|',
+                        TABLE_NAME, CONSTRAINT_NAME, COLUMN_NAME, REFERENCED_TABLE_NAME, REFERENCED_COLUMN_NAME))), 0))
+                    FROM information_schema.KEY_COLUMN_USAGE WHERE TABLE_SCHEMA = %s),
+                (SELECT CONCAT(COUNT(*), ':', COALESCE(SUM(CRC32(CONCAT_WS('|',
+                        ROUTINE_NAME, ROUTINE_TYPE, CREATED, LAST_ALTERED))), 0))
+                    FROM information_schema.ROUTINES WHERE ROUTINE_SCHEMA = %s)
+        """
+        cursor = connection.cursor()
+        cursor.execute(query, (database,) * 5)
+        fingerprint = '/'.join([str(checksum) for checksum in cursor.fetchone()])
+        cursor.close()
+
+        return fingerprint
+
+    def __load_cache(self, cache_file, database, fingerprint):
+        if not isfile(cache_file):
+            return False
+
+        try:
+            with open(cache_file, 'rb') as cache_data:
+                cache = pickle.load(cache_data)
+        except Exception:
+            print('Metadata cache \'%s\' is broken, reloading schema' % (cache_file,))
+            return False
+
+        if cache.get('version') != self.__CACHE_VERSION \
+                or cache.get('database') != database \
+                or cache.get('fingerprint') != fingerprint:
+            return False
+
+        self.tables = cache['tables']
+        self.metadata = cache['metadata']
+        self.routines = cache['routines']
+
+        return True
+
+    def __save_cache(self, cache_file, database, fingerprint):
+        cache = {
+            'version': self.__CACHE_VERSION,
+            'database': database,
+            'fingerprint': fingerprint,
+            'tables': self.tables,
+            'metadata': self.metadata,
+            'routines': self.routines,
+        }
+        cache_dir = dirname(cache_file)
+        if cache_dir:
+            makedirs(cache_dir, exist_ok=True)
+        # write aside and swap, so concurrent runs never read a half written cache
+        with open(cache_file + '.tmp', 'wb') as cache_data:
+            pickle.dump(cache, cache_data, pickle.HIGHEST_PROTOCOL)
+        replace(cache_file + '.tmp', cache_file)
 
     def __load_schema_configuration(self, filename):
         assert isfile(filename), 'Schema file \'%s\' is missing.' % (filename,)
 
         with open(filename) as schema_data:
-            configuration = yaml.load(schema_data)
+            configuration = yaml.safe_load(schema_data)
 
         assert 'tables' in configuration, 'Table list is missing in schema configuration'
 
         return configuration
 
+    # column rows are copied incrementally by (e.g. auto increment key or `updated_at`), if any
+    def get_incremental_field(self, table):
+        field = (self.__schema_configuration['tables'].get(table) or {}).get('incremental')
+        assert not field or field in self.metadata[table]['fields']['__order__'], \
+            'Unknown incremental field %s of table %s' % (field, table,)
+
+        return field
+
     def get_create_table(self, table):
         assert table in self.metadata, 'Unknown table'
 
         return self.metadata[table]['create_sql']
 
-    def __table_create_sql(self, connection, table):
+    def __load_create_sql(self, connection, queries):
+        if not self.__connector or self.__workers < 2 or len(queries) < 2:
+            return self.__fetch_create_sql(connection, queries)
+
+        # SHOW CREATE statements can't be batched, so they are spread over several connections
+        def fetch(queries):
+            worker_connection = self.__connector()
+            try:
+                return self.__fetch_create_sql(worker_connection, queries)
+            finally:
+                worker_connection.close()
+
+        workers = min(self.__workers, len(queries))
+        create_sql = dict()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for result in executor.map(fetch, [queries[i::workers] for i in range(workers)]):
+                create_sql.update(result)
+
+        return create_sql
+
+    def __fetch_create_sql(self, connection, queries):
         cursor = connection.cursor()
-        result = cursor.execute('SHOW CREATE TABLE `%s`' % (table,))
+        create_sql = dict()
 
-        if result:
-            create_sql = cursor.fetchone()[1]
-        else:
-            raise RuntimeError(connection.error())
+        for query in queries:
+            if cursor.execute(query):
+                create_sql[query] = cursor.fetchone()
+            else:
+                raise RuntimeError(connection.error())
 
         cursor.close()
 
@@ -80,8 +202,8 @@ class DataRegistry:
                 self.metadata[table]['refs'],
                 mask,
                 tables[table]['reference'],
-                self.get_table_reader(tables[table]['table']).sql_query(),
-                self.metadata[tables[table]['table']]['fields']
+                self.get_table_reader(tables[table]['table']),
+                tables[table]['strategy'] if 'strategy' in tables[table] else 'auto'
             )
         else:
             assert rule in rules, 'Unkown rule %s' % (rule,)
@@ -105,16 +227,17 @@ class DataRegistry:
         """
         cursor = connection.cursor()
         result = cursor.execute(query, (database,))
+        routine_rows = cursor.fetchall()
+        cursor.close()
+        create_sql = self.__load_create_sql(connection, [
+            'SHOW CREATE %s `%s`' % (routine_type, routine_name) for routine_name, routine_type in routine_rows
+        ])
         routines = list()
 
-        for routine_row in cursor.fetchall():
-            routine_name, routine_type = routine_row
-            cursor.execute('SHOW CREATE %s `%s`' % (routine_type, routine_name))
-            create_sql = cursor.fetchone()[2]
-            create_sql = re.sub('DEFINER=[^\s]+\s', '', create_sql)
-            routines.append(Routine(routine_name, routine_type, create_sql))
-
-        cursor.close()
+        for routine_name, routine_type in routine_rows:
+            routine_sql = create_sql['SHOW CREATE %s `%s`' % (routine_type, routine_name)][2]
+            routine_sql = re.sub('DEFINER=[^\s]+\s', '', routine_sql)
+            routines.append(Routine(routine_name, routine_type, routine_sql))
 
         return routines
 
@@ -132,56 +255,72 @@ class DataRegistry:
 
         return tables
 
-    def __load_references(self, connection, database, table):
-            query = """
-                SELECT t.REFERENCED_TABLE_NAME, t.REFERENCED_COLUMN_NAME, t.COLUMN_NAME
-                FROM information_schema.KEY_COLUMN_USAGE t
-                WHERE t.TABLE_SCHEMA = %s
-                    AND t.TABLE_NAME = %s
-                    AND t.REFERENCED_TABLE_NAME IS NOT NULL
-            """
-            cursor = connection.cursor()
-            result = cursor.execute(query, (database, table,))
-            data = cursor.fetchall()
-            cursor.close()
-            references = dict()
-
-            if (result):
-                for (ref_table_name, ref_table_field, foreign_key) in data:
-                    references[foreign_key] = (ref_table_name, ref_table_field,)
-
-            return references
-
-    def __load_fields(self, connection, database, table):
+    def __load_references(self, connection, database, fields):
         query = """
-            SELECT c.COLUMN_NAME colName, c.COLUMN_KEY keyType, c.DATA_TYPE dataType, c.IS_NULLABLE nullable
+            SELECT t.TABLE_NAME, t.CONSTRAINT_NAME, t.REFERENCED_TABLE_NAME, t.REFERENCED_COLUMN_NAME, t.COLUMN_NAME
+            FROM information_schema.KEY_COLUMN_USAGE t
+            WHERE t.TABLE_SCHEMA = %s
+                AND t.REFERENCED_TABLE_NAME IS NOT NULL
+            ORDER BY t.TABLE_NAME, t.CONSTRAINT_NAME, t.ORDINAL_POSITION
+        """
+        cursor = connection.cursor()
+        result = cursor.execute(query, (database,))
+        data = cursor.fetchall()
+        cursor.close()
+        constraints = dict()
+        references = dict()
+
+        for (table, constraint, ref_table_name, ref_table_field, foreign_key) in data:
+            constraints.setdefault((table, constraint,), list()).append((foreign_key, ref_table_name, ref_table_field,))
+
+        for (table, _), columns in constraints.items():
+            if len(columns) == 1:
+                foreign_key, ref_table_name, ref_table_field = columns[0]
+                references.setdefault(table, dict())[foreign_key] = (ref_table_name, ref_table_field,)
+                continue
+            # multi-column foreign keys map tuples of columns, ordered as the referenced table's columns,
+            # so their values come in the same order as the referenced composite keys
+            ref_table_name = columns[0][1]
+            if ref_table_name in fields:
+                columns.sort(key=lambda column: fields[ref_table_name]['__order__'].index(column[2]))
+            references.setdefault(table, dict())[tuple([column[0] for column in columns])] = \
+                (ref_table_name, tuple([column[2] for column in columns]),)
+
+        return references
+
+    def __load_fields(self, connection, database):
+        query = """
+            SELECT c.TABLE_NAME tableName, c.COLUMN_NAME colName, c.COLUMN_KEY keyType, c.DATA_TYPE dataType, c.IS_NULLABLE nullable
             FROM information_schema.COLUMNS c
             WHERE c.TABLE_SCHEMA = %s
-            AND c.TABLE_NAME = %s
-            ORDER BY c.`ORDINAL_POSITION`
+            ORDER BY c.TABLE_NAME, c.`ORDINAL_POSITION`
         """
         cursor = connection.cursor()
-        result = cursor.execute(query, (database, table,))
+        result = cursor.execute(query, (database,))
         data = cursor.fetchall()
         cursor.close()
+        tables = dict()
+
+        for (table, field_name, field_index, field_type, field_null) in data:
+            if table not in tables:
+                tables[table] = {'__primary__': '', '__order__': list()}
+            fields = tables[table]
+            if field_index == 'PRI':
+                fields['__primary__'] = field_name
+            fields['__order__'].append(field_name)
+            fields[field_name] = {
+                'name': field_name,
+                'index': field_index,
+                'type': field_type,
+                'null': field_null,
+            }
+
+        # __primary__ names single column keys only, composite keys are made of all PRI columns
+        for fields in tables.values():
+            if len(primary_fields(fields)) > 1:
+                fields['__primary__'] = ''
 
-        if (result):
-            fields = dict()
-            fields['__primary__'] = ''
-            fields['__order__'] = list()
-            for (field_name, field_index, field_type, field_null) in data:
-                if field_index == 'PRI':
-                    fields['__primary__'] = field_name
-                fields['__order__'].append(field_name)
-                fields[field_name] = {
-                    'name': field_name,
-                    'index': field_index,
-                    'type': field_type,
-                    'null': field_null,
-                }
-            return fields
-        else:
-            raise ValueError("Table '{}' has no fields".format(table_name))
+        return tables
 
 class Routine:
     def __init__(self, name, type, create_sql):
@@ -189,6 +328,129 @@ class Routine:
         self.type = type
         self.create_sql = create_sql
 
+def primary_fields(fields):
+    return [field for field in fields['__order__'] if fields[field]['index'] == 'PRI']
+
+# composite keys are kept in the cupboard as single values: pairs of integers below 2**32
+# are packed into one integer (so they stay in compact integer sets), other tuples become JSON arrays
+def encode_key(key):
+    if len(key) == 2 and all([isinstance(value, int) and 0 <= value < 1 << 32 for value in key]):
+        return key[0] << 32 | key[1]
+    return json.dumps(key, default=str, separators=(',', ':',))
+
+def decode_key(key):
+    if isinstance(key, bytes):
+        key = key.decode('utf-8')
+    if isinstance(key, int) or key.isdigit():
+        key = int(key)
+        return (key >> 32, key & 0xFFFFFFFF,)
+    return tuple(json.loads(key))
+
+def cast_number(value):
+    return str(int(value))
+
+def cast_decimal(value):
+    return str(float(value))
+
+def cast_string(value):
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def cast_datetime(value):
+    return cast_string(value) if value else '"0000-00-00 00:00:00"'
+
+def cast_date(value):
+    return cast_string(value) if value else '"0000-00-00"'
+
+def cast_time(value):
+    return cast_string(value) if value else '"00:00:00"'
+
+CAST_MAP = {
+    'int': cast_number,
+    'bigint': cast_number,
+    'smallint': cast_number,
+    'tinyint': cast_number,
+    'decimal': cast_decimal,
+    'double': cast_decimal,
+    'char': cast_string,
+    'varchar': cast_string,
+    'text': cast_string,
+    'longtext': cast_string,
+    'date': cast_date,
+    'time': cast_time,
+    'datetime': cast_datetime,
+    'enum': cast_string,
+}
+
+class RecordEncoder:
+    # everything depending on table structure only is resolved once per table,
+    # so encoding a row is a single pass over its values
+    def __init__(self, table, fields, references):
+        order = fields['__order__']
+        self.table = table
+        self.primary_index = order.index(fields['__primary__']) if fields['__primary__'] in order else None
+        primary = primary_fields(fields)
+        self.primary_indexes = tuple([order.index(field) for field in primary]) if len(primary) > 1 else None
+        self.casters = [
+            (CAST_MAP.get(fields[field]['type'], cast_string), fields[field]['null'] == 'YES')
+            for field in order
+        ]
+        self.reference_indexes = [
+            (index, references[field][0]) for index, field in enumerate(order) if field in references
+        ]
+        self.composite_reference_indexes = [
+            (tuple([order.index(field) for field in foreign_key]), reference[0])
+            for foreign_key, reference in references.items() if isinstance(foreign_key, tuple)
+        ]
+
+    def sql(self, record_data):
+        return '(' + ','.join([
+            'NULL' if value is None and nullable else cast(value)
+            for (cast, nullable), value in zip(self.casters, record_data)
+        ]) + ')'
+
+# a chunk of rows exactly as they come from the database, everything else
+# (keys, references, SQL) is derived on demand through the table's encoder
+class RecordChunk:
+    __slots__ = ('encoder', 'rows', 'rendered',)
+
+    def __init__(self, encoder, rows):
+        self.encoder = encoder
+        self.rows = rows
+        # rows in the format of the writer (SQL values or TSV lines), set by TableWriter.render
+        self.rendered = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def last_key(self):
+        if self.encoder.primary_index is None or not self.rows:
+            return None
+        return self.rows[-1][self.encoder.primary_index]
+
+    def primary_keys(self):
+        if self.encoder.primary_indexes:
+            indexes = self.encoder.primary_indexes
+            return [encode_key(tuple([record_data[index] for index in indexes])) for record_data in self.rows]
+        if self.encoder.primary_index is None:
+            return []
+        primary_index = self.encoder.primary_index
+        return [record_data[primary_index] for record_data in self.rows]
+
+    def references(self):
+        for index, table in self.encoder.reference_indexes:
+            for record_data in self.rows:
+                if record_data[index]:
+                    yield (table, record_data[index],)
+        # rows with a NULL in any column of a multi-column foreign key reference nothing
+        for indexes, table in self.encoder.composite_reference_indexes:
+            for record_data in self.rows:
+                key = tuple([record_data[index] for index in indexes])
+                if None not in key:
+                    yield (table, encode_key(key),)
+
+    def sql_values(self):
+        return map(self.encoder.sql, self.rows)
+
 class BaseReader:
     def __init__(self, table, fields, references, mask = None):
         self.table = table
@@ -196,38 +458,111 @@ class BaseReader:
         self.references = references
         self.offset = 0
         self.mask = mask
+        self.key_range = None
+        self.resume_key = None
+        self.increment = None
+        self.encoder = RecordEncoder(table, fields, references)
 
     def set_connection(self, connection):
         self.connection = connection
 
-    def fetch_data(self, chunk_size):
+    def fetch_data(self, chunk_size, pagination = 'keyset', streaming = False, stream_batch_size = 1000):
+        for rows in self.fetch_rows(chunk_size, pagination, streaming, stream_batch_size):
+            yield RecordChunk(self.encoder, rows)
+
+    def fetch_rows(self, chunk_size, pagination = 'keyset', streaming = False, stream_batch_size = 1000):
         assert self.connection, 'Cannot read table data without database connection'
+        assert pagination in PAGINATION_MODES, 'Unknown pagination mode %s' % (pagination,)
+        if streaming:
+            yield from stream(self.connection, self.sql_query(), stream_batch_size)
+            return
         cursor = self.connection.cursor()
-        sql = self.sql_query()
-        sql += ' LIMIT %s, %s'
-        offset = 0
-        while cursor.execute(sql, (offset, chunk_size,)):
-            offset += chunk_size
-            yield [self.populate_record(record_data) for record_data in cursor.fetchall()]
+        seek_field = self.seek_field() if pagination == 'keyset' else None
+        yield from paginate(
+            cursor,
+            self.sql_select(),
+            self.sql_conditions(),
+            chunk_size,
+            '`%s`.`%s`' % (self.table, seek_field,) if seek_field else None,
+            self.fields['__order__'].index(seek_field) if seek_field else None,
+            self.resume_key if seek_field else None
+        )
         cursor.close()
 
+    def resumable(self, pagination = 'keyset', streaming = False, stream_batch_size = 1000):
+        # progress can be tracked only when rows come ordered by an integer key
+        seek_field = self.seek_field()
+        return pagination == 'keyset' and not streaming and bool(seek_field) \
+            and self.fields[seek_field]['type'] in INTEGER_TYPES
+
+    def set_resume_key(self, last_key):
+        self.resume_key = last_key
+
+    def seek_field(self):
+        primary = self.fields['__primary__']
+        # keyset pagination needs a single, unmasked primary key column
+        if not primary or len(primary_fields(self.fields)) != 1 or (self.mask and primary in self.mask):
+            return None
+        return primary
+
     def get_records(self, *keys):
         assert self.connection, 'Cannot read table data without database connection'
 
         cursor = self.connection.cursor()
-        fields = self.__combine_fields()
-        sql = 'SELECT %s FROM `%s` WHERE `%s` IN (%s)' % \
-            (fields, self.table, self.fields['__primary__'], ','.join([key.decode('utf-8') for key in keys]))
-
-        cursor.execute(sql)
-        result = [self.populate_record(record_data) for record_data in cursor.fetchall()]
+        cursor.execute(self.sql_records(*keys))
+        result = RecordChunk(self.encoder, cursor.fetchall())
         cursor.close()
         return result
 
+    def sql_records(self, *keys):
+        primary = primary_fields(self.fields)
+        if len(primary) > 1:
+            # composite keys are looked up by row values, (a, b) IN ((1, 2), ...)
+            return 'SELECT %s FROM `%s` WHERE (%s) IN (%s)' % (
+                self.__combine_fields(),
+                self.table,
+                ','.join(['`%s`' % (field,) for field in primary]),
+                ','.join(['(' + ','.join(map(self.__value_literal, decode_key(key))) + ')' for key in keys]),
+            )
+        return 'SELECT %s FROM `%s` WHERE `%s` IN (%s)' % \
+            (self.__combine_fields(), self.table, self.fields['__primary__'], ','.join([self.__key_literal(key) for key in keys]))
+
+    def __key_literal(self, key):
+        # keys come as bytes from Redis and as plain values from the in-memory cupboard
+        if isinstance(key, bytes):
+            key = key.decode('utf-8')
+        if isinstance(key, int) or key.isdigit():
+            return str(key)
+        return self.connection.literal(key).decode('utf-8')
+
+    def __value_literal(self, value):
+        return str(value) if isinstance(value, int) else self.connection.literal(value).decode('utf-8')
+
     def sql_query(self):
+        return where(self.sql_select(), self.sql_conditions())
+
+    def sql_select(self):
         fields = self.__combine_fields()
         return 'SELECT %s FROM `%s`' % (fields, self.table,)
 
+    def sql_conditions(self):
+        conditions = []
+        if self.key_range:
+            column = '`%s`.`%s`' % (self.table, self.fields['__primary__'],)
+            conditions += ['%s >= %d' % (column, self.key_range[0],), '%s < %d' % (column, self.key_range[1],)]
+        if self.increment:
+            field, since = self.increment
+            since = cast_number(since) if isinstance(since, int) else cast_string(since).replace('%', '%%')
+            conditions.append('`%s`.`%s` >= %s' % (self.table, field, since,))
+        return conditions
+
+    def set_key_range(self, low, high):
+        self.key_range = (low, high,)
+
+    # rows changed since the given value only, rows of that very value are read again
+    def set_increment(self, field, since):
+        self.increment = (field, since,)
+
     def __combine_fields(self):
         if self.mask and len(self.mask):
             fields = []
@@ -241,64 +576,8 @@ class BaseReader:
             fields = ','.join(['`%s`' % field for field in self.fields['__order__']])
         return fields
 
-    def populate_record(self, record_data):
-        def __cast_number(value):
-            return int(value)
-        def __cast_decimal(value):
-            return float(value)
-        def __cast_string(value):
-            return '"{}"'.format(str(value).replace('\\', '\\\\').replace('"', '\\"'))
-        def __cast_datetime(value):
-            return __cast_string(value) if value else '"0000-00-00 00:00:00"'
-        def __cast_date(value):
-            return __cast_string(value) if value else '"0000-00-00"'
-        def __cast_time(value):
-            return __cast_string(value) if value else '"00:00:00"'
-
-        cast_map = {
-            'int': __cast_number,
-            'bigint': __cast_number,
-            'smallint': __cast_number,
-            'tinyint': __cast_number,
-            'decimal': __cast_decimal,
-            'double': __cast_decimal,
-            'double': __cast_decimal,
-            'char': __cast_string,
-            'varchar': __cast_string,
-            'text': __cast_string,
-            'longtext': __cast_string,
-            'date': __cast_date,
-            'time': __cast_time,
-            'datetime': __cast_datetime,
-            'enum': __cast_string,
-        }
-        primary_key = ''
-        record_key = self.table
-        record = list()
-        references = dict()
-
-        for field, value in zip(self.fields['__order__'], record_data):
-            if field == self.fields['__primary__']:
-                primary_key = value
-                record_key += ':' + str(value)
-            if value == None and self.fields[field]['null'] == 'YES':
-                quoted_value = 'NULL'
-            else:
-                cast_type = cast_map.get(self.fields[field]['type'], __cast_string)
-                quoted_value = cast_type(value)
-            record.append(str(quoted_value))
-            if field in self.references:
-                references[self.references[field][0]] = value
-
-        return {
-            'primary_key': primary_key,
-            'record_key': record_key,
-            'record': '(%s)' % (','.join(record),),
-            'references': references,
-        }
-
 class GenericReader(BaseReader):
-    def fetch_data(self, chunk_size):
+    def fetch_rows(self, chunk_size, pagination = 'keyset', streaming = False, stream_batch_size = 1000):
         return []
 
 class ConditionReader(BaseReader):
@@ -306,45 +585,141 @@ class ConditionReader(BaseReader):
         super().__init__(table, fields, references, mask)
         self.where = where
 
-    def sql_query(self):
-        sql = super().sql_query() + ' WHERE ' + self.where
-        return sql
+    def sql_conditions(self):
+        return super().sql_conditions() + ['(%s)' % (self.where,)]
 
 class JoinReader(BaseReader):
-    def __init__(self, table, fields, references, mask, foreign_key, reference_sql, join_fields):
+    __JOIN_CHUNK_SIZE = 20000
+
+    def __init__(self, table, fields, references, mask, foreign_key, join_reader, strategy = 'auto'):
+        assert strategy in JOIN_STRATEGIES, 'Unknown join strategy %s' % (strategy,)
         super().__init__(table, fields, references, mask)
-        self.reference_sql = reference_sql
         self.foreign_key = foreign_key
-        self.join_fields = join_fields
+        self.join_reader = join_reader
+        self.strategy = strategy
 
     def __referenced_column(self):
         if self.foreign_key in self.references:
             return self.references[self.foreign_key][1]
-        elif 'id' in self.join_fields:
+        elif 'id' in self.join_reader.fields:
             return 'id'
         else:
-            return self.join_fields['__primary__']
+            return self.join_reader.fields['__primary__']
+
+    def sql_conditions(self):
+        # the join is always part of own conditions, so joins of joins nest into subqueries
+        return super().sql_conditions() + [
+            '`%s`.`%s` IN (%s)' % (self.table, self.foreign_key, self.__join_keys_query(),)
+        ]
+
+    def __join_keys_query(self):
+        return where(
+            'SELECT `%s`.`%s` FROM `%s`' % (self.join_reader.table, self.__referenced_column(), self.join_reader.table,),
+            self.join_reader.sql_conditions()
+        )
 
-    def fetch_data(self, chunk_size):
+    def fetch_rows(self, chunk_size, pagination = 'keyset', streaming = False, stream_batch_size = 1000):
         assert self.connection, 'Cannot read table data without database connection'
+        assert pagination in PAGINATION_MODES, 'Unknown pagination mode %s' % (pagination,)
+        if self.__choose_strategy() == 'semijoin':
+            yield from super().fetch_rows(chunk_size, pagination, streaming, stream_batch_size)
+            return
+
         ref_cursor = self.connection.cursor()
-        ref_sql = re.sub(
-            'SELECT\s+.+\sFROM',
-            'SELECT `%s` FROM' % (self.__referenced_column(),),
-            self.reference_sql + ' LIMIT %s, %s'
+        ref_seek_field = self.join_reader.seek_field() if pagination == 'keyset' else None
+        ref_sql = 'SELECT `%s`.`%s`' % (self.join_reader.table, self.__referenced_column(),)
+        if ref_seek_field:
+            ref_sql += ', `%s`.`%s`' % (self.join_reader.table, ref_seek_field,)
+        ref_sql += ' FROM `%s`' % (self.join_reader.table,)
+        ref_chunks = paginate(
+            ref_cursor,
+            ref_sql,
+            self.join_reader.sql_conditions(),
+            self.__JOIN_CHUNK_SIZE,
+            '`%s`.`%s`' % (self.join_reader.table, ref_seek_field,) if ref_seek_field else None,
+            1
         )
-        ref_offset = 0
-        ref_chunk_size = 20000
+        seek_field = self.seek_field() if pagination == 'keyset' else None
         cursor = self.connection.cursor()
-        while ref_cursor.execute(ref_sql, (ref_offset, ref_chunk_size,)):
-            ref_offset += ref_chunk_size
-            ref_keys = [str(join_data[0]) for join_data in ref_cursor.fetchall()]
-            sql = self.sql_query()
-            sql += ' WHERE `%s`.`%s` IN (%s)' % (self.table, self.foreign_key, ','.join(ref_keys),)
-            sql += ' LIMIT %s, %s'
-            offset = 0
-            while cursor.execute(sql, (offset, chunk_size,)):
-                offset += chunk_size
-                yield [self.populate_record(record_data) for record_data in cursor.fetchall()]
+        for join_data in ref_chunks:
+            ref_keys = [str(join_row[0]) for join_row in join_data]
+            conditions = super().sql_conditions() + \
+                ['`%s`.`%s` IN (%s)' % (self.table, self.foreign_key, ','.join(ref_keys),)]
+            if streaming:
+                yield from stream(self.connection, where(self.sql_select(), conditions), stream_batch_size)
+                continue
+            yield from paginate(
+                cursor,
+                self.sql_select(),
+                conditions,
+                chunk_size,
+                '`%s`.`%s`' % (self.table, seek_field,) if seek_field else None,
+                self.fields['__order__'].index(seek_field) if seek_field else None
+            )
         cursor.close()
         ref_cursor.close()
+
+    def resumable(self, pagination = 'keyset', streaming = False, stream_batch_size = 1000):
+        # IN lists are read batch by batch, so rows are ordered by key within a batch only
+        return self.strategy == 'semijoin' and super().resumable(pagination, streaming, stream_batch_size)
+
+    def __choose_strategy(self):
+        if self.strategy != 'auto':
+            return self.strategy
+
+        # a key set fitting into a single IN list is cheapest to look up directly,
+        # bigger ones are joined on the server instead of being paged through Python
+        cursor = self.connection.cursor()
+        cursor.execute('EXPLAIN ' + self.__join_keys_query(), ())
+        columns = [column[0].lower() for column in cursor.description]
+        estimate = 1
+        for row in cursor.fetchall():
+            row = dict(zip(columns, row))
+            estimate *= (row.get('rows') or 1) * float(row.get('filtered') or 100) / 100
+        cursor.close()
+        strategy = 'in_list' if estimate <= self.__JOIN_CHUNK_SIZE else 'semijoin'
+        print('Join strategy for table "%s": %s (~%d keys)' % (self.table, strategy, estimate,))
+
+        return strategy
+
+def where(sql, conditions):
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    return sql
+
+# reads query rows chunk by chunk; with a seek column every chunk starts right after
+# the last seen value (keyset pagination), otherwise it falls back to LIMIT offset, n
+def paginate(cursor, sql, conditions, chunk_size, seek_column = None, seek_index = None, last_seen = None):
+    if not seek_column:
+        sql = where(sql, conditions) + ' LIMIT %s, %s'
+        offset = 0
+        while cursor.execute(sql, (offset, chunk_size,)):
+            offset += chunk_size
+            yield cursor.fetchall()
+        return
+
+    order = ' ORDER BY %s LIMIT %%s' % (seek_column,)
+    seek_sql = where(sql, conditions + [seek_column + ' > %s']) + order
+    if last_seen is None:
+        sql, params = where(sql, conditions) + order, (chunk_size,)
+    else:
+        sql, params = seek_sql, (last_seen, chunk_size,)
+    while cursor.execute(sql, params):
+        rows = cursor.fetchall()
+        yield rows
+        if len(rows) < chunk_size:
+            break
+        sql, params = seek_sql, (rows[-1][seek_index], chunk_size,)
+
+# reads the whole query through an unbuffered server-side cursor, so only one batch
+# of rows is held in memory; the cursor has to be drained before the connection is reused
+def stream(connection, sql, batch_size):
+    cursor = connection.cursor(MySQLdb.cursors.SSCursor)
+    try:
+        cursor.execute(sql, ())
+        rows = cursor.fetchmany(batch_size)
+        while rows:
+            yield rows
+            rows = cursor.fetchmany(batch_size)
+    finally:
+        cursor.close()
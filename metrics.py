@@ -0,0 +1,146 @@
+import sys
+import json
+import time
+import threading
+import itertools
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.tables = dict()
+        self.phases = dict()
+        self.iterations = list()
+        self.filters = dict()
+        self.tasks = 0
+        self.active = dict()
+        self.finished = 0
+
+    # time spent, calls, rows and bytes are summed up per table and phase (fetch, encode, persist, cupboard)
+    def add(self, table, phase, seconds = 0.0, rows = 0, bytes = 0, calls = 1):
+        with self.lock:
+            totals = self.tables.setdefault(table, dict()).setdefault(phase, {'time': 0.0, 'calls': 0, 'rows': 0, 'bytes': 0})
+            totals['time'] += seconds
+            totals['calls'] += calls
+            totals['rows'] += rows
+            totals['bytes'] += bytes
+
+    # times every step of the iterator, items are counted as rows
+    def iterate(self, table, phase, items):
+        items = iter(items)
+        try:
+            while True:
+                started_at = time.time()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+                self.add(table, phase, time.time() - started_at, len(item))
+                yield item
+        finally:
+            if hasattr(items, 'close'):
+                items.close()
+
+    def add_phase(self, phase, seconds):
+        with self.lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def add_iteration(self, tables, keys, seconds):
+        with self.lock:
+            self.iterations.append({'tables': tables, 'keys': keys, 'time': round(seconds, 3)})
+
+    # referenced keys checked by the shelf filter and answered in process
+    def add_filter(self, table, lookups, hits):
+        with self.lock:
+            totals = self.filters.setdefault(table, {'lookups': 0, 'hits': 0})
+            totals['lookups'] += lookups
+            totals['hits'] += hits
+
+    def filter_summary(self):
+        with self.lock:
+            lookups = sum([totals['lookups'] for totals in self.filters.values()])
+            hits = sum([totals['hits'] for totals in self.filters.values()])
+        if not lookups:
+            return None
+        return '%d of %d referenced keys answered by shelf filter (%.1f%%)' % (hits, lookups, 100.0 * hits / lookups,)
+
+    def expect_tasks(self, count):
+        with self.lock:
+            self.tasks += count
+
+    def start_task(self, table):
+        with self.lock:
+            self.active[table] = self.active.get(table, 0) + 1
+
+    def finish_task(self, table):
+        with self.lock:
+            self.active[table] -= 1
+            if not self.active[table]:
+                del self.active[table]
+            self.finished += 1
+
+    def rows_written(self):
+        with self.lock:
+            return sum([phases['persist']['rows'] for phases in self.tables.values() if 'persist' in phases])
+
+    def status(self):
+        elapsed = time.time() - self.started_at
+        rows = self.rows_written()
+        with self.lock:
+            active = sorted(self.active)
+            finished, tasks = self.finished, self.tasks
+        return '%02d:%02d:%02d %d rows written (%d rows/s), tasks %d/%d done%s' % (
+            elapsed // 3600, elapsed // 60 % 60, elapsed % 60, rows, rows / elapsed if elapsed else 0,
+            finished, tasks, ', copying: ' + ', '.join(active[:5]) + (' ...' if len(active) > 5 else '') if active else '',
+        )
+
+    def report(self):
+        with self.lock:
+            tables = dict()
+            for table, phases in self.tables.items():
+                tables[table] = dict()
+                for phase, totals in phases.items():
+                    tables[table][phase] = dict(totals, time=round(totals['time'], 3))
+                    if totals['time']:
+                        tables[table][phase]['rows_per_second'] = round(totals['rows'] / totals['time'], 1)
+            return {
+                'started_at': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started_at)),
+                'duration': round(time.time() - self.started_at, 3),
+                'phases': dict([(phase, round(seconds, 3)) for phase, seconds in self.phases.items()]),
+                'reference_iterations': list(self.iterations),
+                'shelf_filter': dict([
+                    (table, dict(totals, hit_rate=round(totals['hits'] / totals['lookups'], 3) if totals['lookups'] else 0.0))
+                    for table, totals in self.filters.items()
+                ]),
+                'tables': tables,
+            }
+
+    def save_report(self, report_file):
+        with open(report_file, 'w') as report:
+            json.dump(self.report(), report, indent=2, sort_keys=True)
+
+# redraws a status line on a terminal until stopped
+class Progress(threading.Thread):
+    def __init__(self, metrics, interval = 0.5, output = sys.stderr):
+        super().__init__(daemon=True)
+        self.metrics = metrics
+        self.interval = interval
+        self.output = output
+        self.stopped = threading.Event()
+
+    def run(self):
+        if not self.output.isatty():
+            return
+        for spinner in itertools.cycle('/-\\|'):
+            self.output.write('\r\033[K' + spinner + ' ' + self.metrics.status())
+            self.output.flush()
+            if self.stopped.wait(self.interval):
+                break
+        self.output.write('\r\033[K')
+        self.output.flush()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+metrics = Metrics()
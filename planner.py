@@ -0,0 +1,155 @@
+from datasource import GenericReader, JoinReader, where
+
+class SlicePlanner:
+    __MAX_ITERATIONS = 100
+
+    def __init__(self, registry, connection, db_name, sample_size = 1000, exact_rows = 1000000):
+        self.registry = registry
+        self.connection = connection
+        self.sample_size = sample_size
+        # tables estimated to be smaller get their rules counted instead of explained
+        self.exact_rows = exact_rows
+        self.statistics = self.__load_statistics(connection, db_name)
+
+    def __load_statistics(self, connection, database):
+        query = """
+            SELECT t.TABLE_NAME, t.TABLE_ROWS, t.AVG_ROW_LENGTH
+            FROM information_schema.TABLES t
+            WHERE t.TABLE_SCHEMA = %s
+        """
+        cursor = connection.cursor()
+        cursor.execute(query, (database,))
+        statistics = dict([
+            (table, {'rows': int(rows or 0), 'row_length': int(row_length or 0)})
+            for table, rows, row_length in cursor.fetchall()
+        ])
+        cursor.close()
+
+        return statistics
+
+    def plan(self, tables):
+        selected = dict()
+        warnings = list()
+        for table in sorted(tables):
+            selected[table], table_warnings = self.__estimate_selection(table)
+            warnings.extend(table_warnings)
+
+        fan_outs = dict()
+        for table in self.registry.tables:
+            for foreign_key, reference in self.registry.metadata[table]['refs'].items():
+                if reference[0] in self.registry.metadata:
+                    fan_outs[(table, foreign_key,)] = self.__sample_fan_out(table, foreign_key)
+
+        # rows selected by a join reference copied parent rows only
+        joined = set()
+        for table in selected:
+            reader = self.registry.get_table_reader(table) if selected[table] else None
+            if isinstance(reader, JoinReader):
+                joined.add((table, reader.foreign_key,))
+
+        referenced, iterations = self.__estimate_references(selected, fan_outs, joined)
+        self.__report(selected, referenced, iterations, warnings)
+
+        return {'selected': selected, 'referenced': referenced, 'iterations': iterations, 'warnings': warnings}
+
+    def __estimate_selection(self, table):
+        try:
+            reader = self.registry.get_table_reader(table)
+        except (AssertionError, KeyError):
+            return 0, ['Table "%s" has no valid rule' % (table,)]
+        # tables copied upon request only get rows through references
+        if isinstance(reader, GenericReader):
+            return 0, []
+
+        total = self.statistics.get(table, {'rows': 0})['rows']
+        warnings = list()
+        cursor = self.connection.cursor()
+        cursor.execute('EXPLAIN ' + reader.sql_query(), ())
+        columns = [column[0].lower() for column in cursor.description]
+        plan = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        cursor.close()
+
+        # rows of the outermost select multiply into the join cardinality, as in JoinReader
+        estimate = 1
+        for row in plan:
+            if row.get('id') == plan[0].get('id'):
+                estimate *= (row.get('rows') or 1) * float(row.get('filtered') or 100) / 100
+            # scanning a whole table to select a part of it means there is no index for the rule
+            if str(row.get('type')).upper() == 'ALL' and float(row.get('filtered') or 100) < 100:
+                warnings.append('Rule of table "%s" scans table "%s" (~%d rows) without index%s' % (
+                    table, row.get('table'), row.get('rows') or 0,
+                    '' if row.get('possible_keys') else ', no usable keys',
+                ))
+
+        if total < self.exact_rows:
+            cursor = self.connection.cursor()
+            cursor.execute(where('SELECT COUNT(*) FROM `%s`' % (table,), reader.sql_conditions()), ())
+            estimate = cursor.fetchone()[0]
+            cursor.close()
+
+        return int(min(estimate, total) if total else estimate), warnings
+
+    # distinct referenced keys per row (NULLs excluded), in a sample of the table
+    def __sample_fan_out(self, table, foreign_key):
+        columns = foreign_key if isinstance(foreign_key, tuple) else (foreign_key,)
+        cursor = self.connection.cursor()
+        cursor.execute(
+            'SELECT COUNT(*), COUNT(DISTINCT %s) FROM (SELECT %s FROM `%s` LIMIT %d) s' % (
+                ', '.join(['s.`%s`' % (column,) for column in columns]),
+                ', '.join(['`%s`' % (column,) for column in columns]),
+                table,
+                self.sample_size,
+            )
+        )
+        rows, keys = cursor.fetchone()
+        cursor.close()
+
+        return float(keys) / rows if rows else 0.0
+
+    # follows references the way persist_references does, every iteration copies the keys
+    # found in the previous one which are not copied yet (assuming keys are spread evenly)
+    def __estimate_references(self, selected, fan_outs, joined):
+        copied = dict([(table, float(selected.get(table, 0))) for table in self.registry.tables])
+        referenced = dict([(table, 0.0) for table in self.registry.tables])
+        added = dict(copied)
+        iterations = 0
+        while iterations < self.__MAX_ITERATIONS:
+            pending = dict()
+            for (table, foreign_key), fan_out in fan_outs.items():
+                if not iterations and (table, foreign_key,) in joined:
+                    continue
+                parent = self.registry.metadata[table]['refs'][foreign_key][0]
+                total = self.statistics.get(parent, {'rows': 0})['rows']
+                keys = min(added[table] * fan_out, total)
+                missing = 1 - min(copied[parent] / total, 1) if total else 0
+                pending[parent] = pending.get(parent, 0.0) + keys * missing
+            if not any([keys >= 1 for keys in pending.values()]):
+                break
+            iterations += 1
+            added = dict([(table, 0.0) for table in self.registry.tables])
+            for table, keys in pending.items():
+                total = self.statistics.get(table, {'rows': 0})['rows']
+                keys = min(keys, max(total - copied[table], 0))
+                added[table] = keys
+                copied[table] += keys
+                referenced[table] += keys
+
+        return dict([(table, int(keys)) for table, keys in referenced.items()]), iterations
+
+    def __report(self, selected, referenced, iterations, warnings):
+        print('%-32s %12s %12s %12s %10s' % ('table', 'by rule', 'referenced', 'total', 'MB'))
+        rows, size = 0, 0
+        for table in sorted(self.registry.tables):
+            table_rows = selected.get(table, 0) + referenced.get(table, 0)
+            if not table_rows:
+                continue
+            statistics = self.statistics.get(table, {'rows': 0, 'row_length': 0})
+            table_size = table_rows * statistics['row_length']
+            rows += table_rows
+            size += table_size
+            print('%-32s %12d %12d %12d %10.1f' % (
+                table, selected.get(table, 0), referenced.get(table, 0), statistics['rows'], table_size / 1048576,
+            ))
+        print('Estimated rows: %d, size: %.1f MB, reference iterations: %d' % (rows, size / 1048576, iterations,))
+        for warning in warnings:
+            print('Warning:', warning)
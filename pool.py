@@ -0,0 +1,246 @@
+import time
+import threading
+import MySQLdb
+from util import connection_parameters
+
+# connections to every server (e.g. read replica) are reused and limited per server;
+# with a target latency or replication lag set, queries are throttled per server
+# by an AIMD rate limiter: the rate grows steadily while the server keeps up and halves when it doesn't
+class ConnectionPool:
+    # access denied, unknown database and unknown host won't pass on retry
+    __FATAL_ERRORS = (1044, 1045, 1049, 2005,)
+
+    def __init__(self, parameter_sets, per_replica = 4, cooldown = 30, idle_check = 60,
+                 target_latency = None, max_lag = None, lag_check_interval = 10,
+                 min_rate = 0.5, max_rate = 50, increase = 1, **options):
+        assert per_replica > 1, 'Pool needs at least 2 connections per server'
+        self.condition = threading.Condition()
+        self.cooldown = cooldown
+        self.idle_check = idle_check
+        self.replicas = [
+            Replica(
+                connection_parameters(parameters, **options),
+                per_replica,
+                Throttle(target_latency, max_lag, lag_check_interval, min_rate, max_rate, increase)
+                    if target_latency or max_lag else None
+            )
+            for parameters in parameter_sets
+        ]
+
+    # the pool is used the same way as connection factories
+    # every server is tried at most once per call, the error is raised once all of them fail
+    def __call__(self):
+        failures = 0
+        while True:
+            replica = self.__reserve()
+            try:
+                connection = self.__open(replica)
+            except MySQLdb.OperationalError as error:
+                failures += 1
+                fatal = error.args and error.args[0] in self.__FATAL_ERRORS
+                print('Connection to %s:%s failed%s: %s' % (
+                    replica.parameters['host'], replica.parameters['port'],
+                    '' if fatal or failures >= len(self.replicas) else ', skipping it for %ds' % (self.cooldown,), error,
+                ))
+                with self.condition:
+                    replica.busy -= 1
+                    replica.failed_until = time.time() + self.cooldown
+                    self.condition.notify_all()
+                if fatal or failures >= len(self.replicas):
+                    raise
+                continue
+            pooled = PooledConnection(self, replica, connection)
+            if replica.throttle:
+                try:
+                    replica.throttle.check_lag(connection)
+                except BaseException:
+                    pooled.close()
+                    raise
+            return pooled
+
+    def __reserve(self):
+        with self.condition:
+            while True:
+                now = time.time()
+                available = [replica for replica in self.replicas if replica.busy < replica.limit]
+                healthy = [replica for replica in available if replica.failed_until <= now]
+                # failed servers are retried once all of the others fail too
+                candidates = healthy or ([] if any([replica.failed_until <= now for replica in self.replicas]) else available)
+                if candidates:
+                    replica = min(candidates, key=lambda replica: (replica.busy, replica.failed_until,))
+                    replica.busy += 1
+                    return replica
+                self.condition.wait(1)
+
+    def __open(self, replica):
+        with self.condition:
+            idle = replica.idle.pop() if replica.idle else None
+        if idle:
+            connection, released_at = idle
+            if time.time() - released_at < self.idle_check:
+                return connection
+            try:
+                connection.ping()
+                return connection
+            except MySQLdb.Error:
+                connection.close()
+        return MySQLdb.connect(**replica.parameters)
+
+    def release(self, replica, connection):
+        try:
+            # nothing uncommitted leaks to the next user of the connection
+            connection.rollback()
+            reusable = True
+        except MySQLdb.Error:
+            connection.close()
+            reusable = False
+        with self.condition:
+            if reusable:
+                replica.idle.append((connection, time.time(),))
+            replica.busy -= 1
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            for replica in self.replicas:
+                for connection, _ in replica.idle:
+                    connection.close()
+                replica.idle = list()
+
+class Replica:
+    def __init__(self, parameters, limit, throttle):
+        self.parameters = parameters
+        self.limit = limit
+        self.throttle = throttle
+        self.busy = 0
+        self.idle = list()
+        self.failed_until = 0
+
+class Throttle:
+    # MySQL 8.0.22+ syntax first, older servers and MariaDB only know the previous one
+    __LAG_QUERIES = (
+        ('SHOW REPLICA STATUS', 'Seconds_Behind_Source',),
+        ('SHOW SLAVE STATUS', 'Seconds_Behind_Master',),
+    )
+
+    def __init__(self, target_latency, max_lag, lag_check_interval, min_rate, max_rate, increase):
+        self.lock = threading.Lock()
+        self.target_latency = target_latency
+        self.max_lag = max_lag
+        self.lag_check_interval = lag_check_interval
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.rate = max_rate
+        self.next_query_at = 0
+        self.decreased_at = 0
+        self.lag_checked_at = 0
+        self.lag_queries = self.__LAG_QUERIES
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = max(self.next_query_at - now, 0)
+            self.next_query_at = max(self.next_query_at, now) + 1 / self.rate
+        if delay:
+            time.sleep(delay)
+
+    def observe(self, latency):
+        if self.target_latency and latency > self.target_latency:
+            self.decrease('query took %.2fs' % (latency,))
+        else:
+            with self.lock:
+                # about `increase` queries per second more every second
+                self.rate = min(self.rate + self.increase / self.rate, self.max_rate)
+
+    def decrease(self, reason):
+        with self.lock:
+            now = time.time()
+            # one decrease per second, a burst of slow queries is a single congestion signal
+            if now - self.decreased_at < 1:
+                return
+            self.decreased_at = now
+            self.rate = max(self.rate / 2, self.min_rate)
+            rate = self.rate
+        print('Reads throttled to %.1f queries/s: %s' % (rate, reason,))
+
+    def check_lag(self, connection):
+        if not self.max_lag:
+            return
+        with self.lock:
+            if time.time() - self.lag_checked_at < self.lag_check_interval:
+                return
+            self.lag_checked_at = time.time()
+        for statement, field in self.lag_queries:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(statement)
+                status = cursor.fetchone()
+                columns = [column[0] for column in cursor.description] if cursor.description else []
+                break
+            except MySQLdb.Error as error:
+                last_error = error
+            finally:
+                cursor.close()
+        else:
+            # e.g. no REPLICATION CLIENT privilege, reads go on throttled by latency only
+            print('Replication lag checks disabled: %s' % (last_error,))
+            self.max_lag = None
+            return
+        # later checks go straight to the statement the server understands
+        self.lag_queries = ((statement, field,),)
+        if not status:
+            return
+        lag = dict(zip(columns, status)).get(field)
+        if lag is not None and lag > self.max_lag:
+            self.decrease('replication lag %ds' % (lag,))
+
+# returns the connection to the pool on close(), queries of throttled servers are paced and timed
+class PooledConnection:
+    def __init__(self, pool, replica, connection):
+        self.pool = pool
+        self.replica = replica
+        self.connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def cursor(self, *args):
+        cursor = self.connection.cursor(*args)
+        return ThrottledCursor(cursor, self.replica.throttle, self.connection) if self.replica.throttle else cursor
+
+    def query(self, sql):
+        if not self.replica.throttle:
+            return self.connection.query(sql)
+        self.replica.throttle.check_lag(self.connection)
+        self.replica.throttle.wait()
+        started_at = time.time()
+        result = self.connection.query(sql)
+        self.replica.throttle.observe(time.time() - started_at)
+        return result
+
+    def close(self):
+        if self.connection:
+            connection, self.connection = self.connection, None
+            self.pool.release(self.replica, connection)
+
+# connections are held for whole tasks, so replication lag is checked (every lag_check_interval) by queries too
+class ThrottledCursor:
+    def __init__(self, cursor, throttle, connection):
+        self.cursor = cursor
+        self.throttle = throttle
+        self.connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def execute(self, *args):
+        self.throttle.check_lag(self.connection)
+        self.throttle.wait()
+        started_at = time.time()
+        result = self.cursor.execute(*args)
+        self.throttle.observe(time.time() - started_at)
+        return result
@@ -1,14 +1,24 @@
 import sys
+import time
+import asyncio
 import datetime
+from os.path import join
 from concurrent.futures import ThreadPoolExecutor
 from random import randint
 from config import Configuration
 from datasource import DataRegistry
 from slicer import SlicingMachine,cleanup
-from cupboard import RedisCupboard
+from cupboard import RedisCupboard, MemoryCupboard, ShelfFilter
+from scheduler import TableScheduler
+from planner import SlicePlanner
+from async_slicer import AsyncSlicingMachine
+from metrics import metrics, Progress
+from pool import ConnectionPool
 from util import resolve_settings, \
-                 get_connection_factory, \
-                 copy_database_schema
+                 copy_database_schema, \
+                 create_deferred_indexes, \
+                 relax_durability, \
+                 restore_durability
 
 if __name__ == '__main__':
     settings = resolve_settings(sys.argv[1:])
@@ -16,22 +26,35 @@ if __name__ == '__main__':
 
     mysql_params = [configuration.get_mysql_parameters(connection_name) for connection_name in settings['read'].split(',')];
     read_connection_params = mysql_params[0];
-    read_connection_creator = get_connection_factory(*mysql_params)
+    # connections are reused across tables and reference iterations, limited and throttled per server
+    pool_params = configuration.get_pool_parameters()
+    pool_params.setdefault('per_replica', configuration.get_max_workers() + 1)
+    read_connection_creator = ConnectionPool(mysql_params, **pool_params)
 
+    writer_params = configuration.get_writer_parameters()
     write_connection_params = configuration.get_mysql_parameters(settings['write'])
-    write_connection_creator = get_connection_factory(write_connection_params)
+    write_pool_params = dict([
+        (name, value) for name, value in pool_params.items() if name in ('per_replica', 'cooldown', 'idle_check',)
+    ])
+    if writer_params.get('backend') == 'load_data':
+        write_pool_params['local_infile'] = 1
+    write_connection_creator = ConnectionPool([write_connection_params], **write_pool_params)
+
+    metadata_cache_file = None
+    if configuration.get_metadata_cache_dir():
+        metadata_cache_file = join(
+            configuration.get_metadata_cache_dir(),
+            '%s-%s-%s.pickle' % (read_connection_params['host'], read_connection_params['port'], read_connection_params['database'],)
+        )
 
     read_connection = read_connection_creator()
     data_registry = DataRegistry(
         read_connection_params['database'],
         settings['schema_file'],
-        read_connection
-    )
-    slicing_machine = SlicingMachine(
-        data_registry,
+        read_connection,
         read_connection_creator,
-        write_connection_creator,
-        RedisCupboard(settings['cleanup'], **configuration.get_redis_parameters())
+        configuration.get_max_workers(),
+        metadata_cache_file
     )
 
     if len(settings['tables']):
@@ -41,25 +64,137 @@ if __name__ == '__main__':
     else:
         table_list = data_registry.tables
 
+    # dry run, nothing is written and interim storage is left untouched
+    if settings['plan']:
+        SlicePlanner(
+            data_registry,
+            read_connection,
+            read_connection_params['database'],
+            **configuration.get_planner_parameters()
+        ).plan(table_list)
+        read_connection.close()
+        sys.exit()
+
+    # incremental runs rely on keys and watermarks left in the cupboard by previous runs
+    assert not settings['incremental'] or configuration.get_cupboard_backend() != 'memory', \
+        'Incremental runs need Redis cupboard'
+    assert not settings['incremental'] or settings['engine'] == 'threads', \
+        'Incremental runs are supported by threads engine only'
+
+    if configuration.get_cupboard_backend() == 'memory':
+        cupboard = MemoryCupboard(settings['cleanup'])
+    else:
+        cupboard = RedisCupboard(settings['cleanup'] and not settings['incremental'], **configuration.get_redis_parameters())
+        shelf_filter_params = configuration.get_shelf_filter_parameters()
+        if shelf_filter_params.get('cached_keys', 100000):
+            cupboard = ShelfFilter(cupboard, **shelf_filter_params)
+
+    slicing_machine = SlicingMachine(
+        data_registry,
+        read_connection_creator,
+        write_connection_creator,
+        cupboard,
+        configuration.get_reader_parameters(),
+        writer_params,
+        configuration.get_max_workers(),
+        resume=not settings['cleanup'],
+        incremental=settings['incremental'],
+        **configuration.get_slicer_parameters()
+    )
+
+    scheduler = TableScheduler(data_registry, read_connection, read_connection_params['database'])
+    table_list = scheduler.order(table_list, configuration.get_max_workers())
+
+    assert not settings['defer_indexes'] or settings['copy_schema'] or not settings['cleanup'], \
+        'Indexes can be deferred when copying schema or resuming such a run only'
+
     write_connection = write_connection_creator()
+    phase_started_at = time.time()
 
     # copying schema imply recreating write database
     if settings['copy_schema']:
-        copy_database_schema(data_registry, write_connection)
+        deferred_indexes = copy_database_schema(data_registry, write_connection, settings['defer_indexes'])
+        # deferred indexes are kept in the cupboard to be created by a resumed run as well
+        for table, definitions in deferred_indexes.items():
+            cupboard.save_checkpoint(table, 'indexes', {'definitions': definitions})
+        metrics.add_phase('schema', time.time() - phase_started_at)
+        print('Schema copied in %.1fs' % (time.time() - phase_started_at,))
     # in case schema is not copied existing tables will be truncated
     # TODO check whether ALL tables should be trucated when '--tables' specified
-    elif settings['cleanup']:
+    elif settings['cleanup'] and not settings['incremental']:
         cleanup(write_connection, data_registry.tables)
 
-    write_connection.close()
-    read_connection.close()
+    flush_log = relax_durability(write_connection) if writer_params.get('fast_load') else None
+    progress = Progress(metrics)
+
+    # durability relaxed above is restored whatever fails from here on
+    try:
+        write_connection.close()
+        read_connection.close()
+
+        started_at = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
+
+        # big tables are sliced by several workers, one primary key range each
+        tasks = [task for table in table_list for task in slicing_machine.split_table(table)]
+        metrics.expect_tasks(len(tasks))
+        progress.start()
+
+        if settings['engine'] == 'async':
+            # one event loop drives all tables, concurrency is set per kind of calls instead of workers
+            async_slicing_machine = AsyncSlicingMachine(
+                data_registry,
+                mysql_params,
+                write_connection_params,
+                cupboard,
+                configuration.get_reader_parameters(),
+                writer_params,
+                resume=not settings['cleanup'],
+                reference_split_size=configuration.get_slicer_parameters().get('reference_split_size', 100000),
+                **configuration.get_async_parameters()
+            )
+            phase_started_at = time.time()
+            asyncio.run(async_slicing_machine.run(tasks))
+            metrics.add_phase('slicing', time.time() - phase_started_at)
+            print('Tables sliced and references copied in %.1fs' % (time.time() - phase_started_at,))
+        else:
+            phase_started_at = time.time()
+            with ThreadPoolExecutor(max_workers=configuration.get_max_workers()) as executor:
+                executor.map(lambda task: slicing_machine.slice_table(*task), tasks)
+            metrics.add_phase('slicing', time.time() - phase_started_at)
+            print('Tables sliced in %.1fs' % (time.time() - phase_started_at,))
 
-    started_at = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
+            phase_started_at = time.time()
+            slicing_machine.persist_references()
+            metrics.add_phase('references', time.time() - phase_started_at)
+            print('References copied in %.1fs' % (time.time() - phase_started_at,))
 
-    with ThreadPoolExecutor(max_workers=configuration.get_max_workers()) as executor:
-        executor.map(slicing_machine.slice_table, table_list)
+        slicing_machine.finish_increments(tasks)
 
-    slicing_machine.persist_references()
+        if settings['defer_indexes']:
+            phase_started_at = time.time()
+            deferred_indexes = dict()
+            for table in data_registry.tables:
+                checkpoint = cupboard.load_checkpoint(table, 'indexes')
+                if checkpoint:
+                    deferred_indexes[table] = checkpoint['definitions']
+            created = create_deferred_indexes(write_connection_creator, deferred_indexes, configuration.get_max_workers())
+            for table in [table for table in created if created[table]]:
+                cupboard.save_checkpoint(table, 'indexes', {'definitions': []})
+            metrics.add_phase('indexes', time.time() - phase_started_at)
+            print('Indexes created in %.1fs' % (time.time() - phase_started_at,))
+    finally:
+        if progress.is_alive():
+            progress.stop()
+        write_connection = write_connection_creator()
+        restore_durability(write_connection, flush_log)
+        write_connection.close()
+        read_connection_creator.close()
+        write_connection_creator.close()
+        if settings['report_file']:
+            metrics.save_report(settings['report_file'])
+            print('Report saved to', settings['report_file'])
 
+    if metrics.filter_summary():
+        print(metrics.filter_summary())
     print('started copying data at', started_at)
     print('completed at', datetime.datetime.now().strftime("%Y-%m-%d %H:%M"))
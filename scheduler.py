@@ -0,0 +1,83 @@
+from datasource import GenericReader
+
+class TableScheduler:
+    def __init__(self, registry, connection, db_name):
+        self.registry = registry
+        self.row_estimates = self.__load_row_estimates(connection, db_name)
+
+    def __load_row_estimates(self, connection, database):
+        query = """
+            SELECT t.TABLE_NAME, t.TABLE_ROWS
+            FROM information_schema.TABLES t
+            WHERE t.TABLE_SCHEMA = %s
+        """
+        cursor = connection.cursor()
+        cursor.execute(query, (database,))
+        estimates = dict([(table, int(rows or 0)) for table, rows in cursor.fetchall()])
+        cursor.close()
+
+        return estimates
+
+    def order(self, tables, workers = 1):
+        tables = set(tables)
+        weights = dict([(table, self.__weight(table)) for table in tables])
+        children = dict([(table, set()) for table in tables])
+        for table in tables:
+            for reference in self.registry.metadata[table]['refs'].values():
+                parent = reference[0]
+                if parent in tables and parent != table:
+                    children[parent].add(table)
+
+        # rank of a table is its own weight plus the heaviest chain of tables referencing it,
+        # so referenced tables start before their children and heavy chains start first
+        ranks = dict()
+        for table in tables:
+            self.__rank(table, weights, children, ranks, set())
+        ordered = sorted(tables, key=lambda table: (-ranks[table], -weights[table], table))
+
+        self.__report(ordered, weights, children, ranks, workers)
+
+        return ordered
+
+    def __weight(self, table):
+        try:
+            reader = self.registry.get_table_reader(table)
+        except (AssertionError, KeyError):
+            return 0
+        # tables copied upon request only are not read by workers
+        if isinstance(reader, GenericReader):
+            return 0
+        return self.row_estimates.get(table, 0)
+
+    def __rank(self, table, weights, children, ranks, path):
+        if table in ranks:
+            return ranks[table]
+        path.add(table)
+        # references closing a cycle are ignored
+        heaviest = max([
+            self.__rank(child, weights, children, ranks, path) for child in children[table] if child not in path
+        ] or [0])
+        path.remove(table)
+        ranks[table] = weights[table] + heaviest
+
+        return ranks[table]
+
+    def __report(self, ordered, weights, children, ranks, workers):
+        if not ordered:
+            return
+
+        critical_path = [ordered[0]]
+        while True:
+            candidates = [child for child in children[critical_path[-1]] if child not in critical_path]
+            if not candidates:
+                break
+            critical_path.append(max(candidates, key=lambda child: ranks[child]))
+
+        # greedy assignment of tables to the first free worker, as the executor does it
+        loads = [0] * max(workers, 1)
+        for table in ordered:
+            loads[loads.index(min(loads))] += weights[table]
+
+        print('Table order:', ', '.join(ordered))
+        print('Critical path (~%d rows): %s' % (ranks[ordered[0]], ' -> '.join(critical_path),))
+        print('Estimated rows per worker:', ', '.join([str(load) for load in sorted(loads, reverse=True)]))
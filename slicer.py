@@ -1,5 +1,14 @@
 import _mysql
 import sys
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
+from math import ceil
+from datasource import RecordChunk, GenericReader, INTEGER_TYPES
+from metrics import metrics
+from tempfile import NamedTemporaryFile
 
 class SlicingMachine:
     registry = None
@@ -7,123 +16,458 @@ class SlicingMachine:
     write_connector = None
     cupboard = None
     __CHUNK_SIZE = 20000
+    __REFERENCES_LIMIT = 100000
 
-    def __init__(self, registry, read_connector, write_connector, cupboard):
+    def __init__(self, registry, read_connector, write_connector, cupboard, reader_options = None, writer_options = None,
+                 max_workers = 1, reference_split_size = 100000, pipeline_depth = 2, split_rows = 5000000, resume = False,
+                 incremental = False):
         self.registry = registry
         self.read_connector = read_connector
         self.write_connector = write_connector
         self.cupboard = cupboard
+        self.reader_options = reader_options if reader_options else {}
+        self.writer_options = writer_options if writer_options else {}
+        self.max_workers = max_workers
+        self.reference_split_size = reference_split_size
+        self.pipeline_depth = pipeline_depth
+        self.split_rows = split_rows
+        self.resume = resume
+        # only rows changed since the previous run are read and upserted into existing target tables
+        self.incremental = incremental
+        self.increments = dict()
 
-    def slice_table(self, table):
-        print('Start table:', table)
+    def split_table(self, table):
+        try:
+            reader = self.registry.get_table_reader(table)
+        except (AssertionError, KeyError):
+            # slice_table reports misconfigured tables
+            return [(table, None,)]
+        # checkpoints of previous runs would skip tasks of a new incremental one
+        if self.incremental and not self.resume:
+            self.cupboard.clear_checkpoints(table, 'increment', 'indexes')
+        since = self.__start_increment(table, reader)
+        seek_field = reader.seek_field()
+        if not self.split_rows or isinstance(reader, GenericReader) or not seek_field \
+                or reader.fields[seek_field]['type'] not in INTEGER_TYPES or since is not None:
+            return [(table, None,)]
+
+        # resumed runs have to get the same ranges as checkpoints refer to
+        if self.resume:
+            split = self.cupboard.load_checkpoint(table, 'split')
+            if split:
+                return [(table, tuple(key_range) if key_range else None,) for key_range in split['ranges']]
+
+        read_connection = self.read_connector()
+        try:
+            cursor = read_connection.cursor()
+            cursor.execute(
+                'SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s',
+                (table,)
+            )
+            estimate = cursor.fetchone()
+            estimate = int(estimate[0] or 0) if estimate else 0
+            low, high = None, None
+            if estimate >= self.split_rows:
+                cursor.execute('SELECT MIN(`%s`), MAX(`%s`) FROM `%s`' % (seek_field, seek_field, table,))
+                low, high = cursor.fetchone()
+            cursor.close()
+        finally:
+            read_connection.close()
+
+        if low is None or high <= low:
+            ranges = [None]
+        else:
+            # ranges are of equal width, more of them than workers evens out skewed key distributions
+            count = min(ceil(estimate / self.split_rows), self.max_workers * 4)
+            width = ceil((high - low + 1) / count)
+            ranges = [(start, min(start + width, high + 1),) for start in range(low, high + 1, width)]
+            print('Table "%s" is split into %d key ranges' % (table, len(ranges),))
+        self.cupboard.save_checkpoint(table, 'split', {'ranges': ranges})
+
+        return [(table, key_range,) for key_range in ranges]
+
+    # the highest value of the incremental field is taken before the table is read and becomes
+    # the starting point of the next incremental run once all tasks of the table are done;
+    # resumed runs keep the one of the interrupted run, so rows changed meanwhile aren't skipped
+    def __start_increment(self, table, reader):
+        field = self.registry.get_incremental_field(table)
+        if not field or isinstance(reader, GenericReader):
+            return None
+        state = self.cupboard.load_checkpoint(table, 'increment') or {'since': None, 'next': None}
+        if not self.resume or state['next'] is None:
+            read_connection = self.read_connector()
+            try:
+                cursor = read_connection.cursor()
+                cursor.execute('SELECT MAX(`%s`) FROM `%s`' % (field, table,))
+                high = cursor.fetchone()[0]
+                cursor.close()
+            finally:
+                read_connection.close()
+            state['next'] = high if high is None or isinstance(high, int) else str(high)
+            self.cupboard.save_checkpoint(table, 'increment', state)
+        since = state['since'] if self.incremental else None
+        if since is not None:
+            print('Table "%s" is copied incrementally from %s = %s' % (table, field, since,))
+        self.increments[table] = (field, since,)
+
+        return since
+
+    def finish_increments(self, tasks):
+        for table in self.increments:
+            checkpoints = [
+                self.cupboard.load_checkpoint(table, task_id(key_range))
+                for task_table, key_range in tasks if task_table == table
+            ]
+            if not all([checkpoint and checkpoint['done'] for checkpoint in checkpoints]):
+                print('Table "%s" is not copied completely, its next increment starts at the same point' % (table,))
+                continue
+            state = self.cupboard.load_checkpoint(table, 'increment')
+            if state['next'] is not None:
+                self.cupboard.save_checkpoint(table, 'increment', {'since': state['next'], 'next': state['next']})
+
+    def slice_table(self, table, key_range = None):
+        task = task_id(key_range)
+        checkpoint = self.cupboard.load_checkpoint(table, task) if self.resume else None
+        metrics.start_task(table)
+        if checkpoint and checkpoint['done']:
+            print('Skip table:', table, '[%s, %s)' % key_range if key_range else '', '(already copied)')
+            metrics.finish_task(table)
+            return
+
+        print('Start table:', table, '[%s, %s)' % key_range if key_range else '')
+        # settings are resolved before connections are taken, so a misconfigured table holds none of them
+        try:
+            reader = copy(self.registry.get_table_reader(table))
+            writer_settings = self.__writer_settings(table)
+        except:
+            metrics.finish_task(table)
+            raise
         read_connection = self.read_connector()
-        write_connection = self.write_connector()
-        reader = self.registry.get_table_reader(table)
-        writer = self.__create_table_writer(table, write_connection)
+        write_connection = None
+        try:
+            write_connection = self.write_connector()
+            writer = self.__create_table_writer(table, write_connection, writer_settings)
+            self.__slice(table, key_range, task, checkpoint, reader, writer, read_connection)
+        finally:
+            if write_connection:
+                write_connection.close()
+            read_connection.close()
+            metrics.finish_task(table)
 
+    def __slice(self, table, key_range, task, checkpoint, reader, writer, read_connection):
+        if key_range:
+            reader.set_key_range(*key_range)
+        field, since = self.increments.get(table, (None, None,))
+        if since is not None:
+            reader.set_increment(field, since)
+        # with periodic commits progress is checkpointed after every commit, keyset paginated
+        # tasks restart after the last committed key, the others are read again from the start
+        resumable = writer.periodic and reader.resumable(**self.reader_options)
+        if checkpoint and checkpoint['last_key'] is not None and resumable:
+            print('Resume table:', table, 'after key', checkpoint['last_key'])
+            reader.set_resume_key(checkpoint['last_key'])
+
+        # without periodic commits keys are shelved ahead of the commit and taken back if the task fails,
+        # key ranges take back their own keys only, as other ranges of the table may be committed
+        shelved = list() if key_range and not writer.periodic else None
         try:
             reader.set_connection(read_connection)
+            primary_keys = list()
             references = set()
-            for records in reader.fetch_data(self.__CHUNK_SIZE):
-                record_keys = list()
-                for record in records:
-                    record_keys.append(record['primary_key'])
-                    for ref_table, primary_key in record['references'].items():
-                        if primary_key:
-                            references.add((ref_table, primary_key,))
-                self.cupboard.put_on_shelf(table, *record_keys)
-                writer.persist(*records)
+            chunks = pipeline(
+                metrics.iterate(table, 'fetch', reader.fetch_rows(self.__CHUNK_SIZE, **self.reader_options)),
+                [
+                    lambda rows: writer.render(RecordChunk(reader.encoder, rows)),
+                    lambda chunk: self.__shelve_records(table, chunk, not writer.periodic, shelved),
+                ],
+                self.pipeline_depth
+            )
+            try:
+                for chunk, chunk_keys, chunk_references in chunks:
+                    # rows committed right before an interruption may be read again, also when
+                    # the interruption came between the commit and saving its keys and checkpoint
+                    writer.persist(chunk, ignore_duplicates = self.resume, upsert = self.incremental)
+                    references.update(chunk_references)
+                    if writer.periodic:
+                        primary_keys.extend(chunk_keys)
+                    if writer.commit_due():
+                        writer.commit()
+                        self.__shelve_committed(table, primary_keys, references)
+                        self.cupboard.save_checkpoint(
+                            table, task, {'last_key': chunk.last_key() if resumable else None, 'done': False}
+                        )
+                    # keep pending references bounded for huge (e.g. streamed) tables
+                    elif not writer.periodic and len(references) >= self.__REFERENCES_LIMIT:
+                        self.cupboard.put_on_reference_shelf(references)
+                        references.clear()
+            finally:
+                chunks.close()
             print('Commit table:', table)
             writer.commit()
-            self.cupboard.put_on_reference_shelf(references)
+            self.__shelve_committed(table, primary_keys, references)
+            self.cupboard.save_checkpoint(table, task, {'last_key': None, 'done': True})
         except:
             print('Error when copying table "%s"' % (table,))
             print(sys.exc_info()[1])
             if read_connection.errno():
                 print(read_connection.error())
-            self.cupboard.clear_shelf(table)
+            # committed parts stay, together with their keys and checkpoint
+            if shelved is not None:
+                self.cupboard.remove_from_shelf(table, *shelved)
+            elif not writer.periodic:
+                self.cupboard.clear_shelf(table)
             writer.rollback()
 
-        read_connection.close()
-        write_connection.close()
+    def __shelve_committed(self, table, primary_keys, references):
+        self.cupboard.put_on_shelf(table, *primary_keys)
+        self.cupboard.put_on_reference_shelf(references)
+        primary_keys.clear()
+        references.clear()
+
+    def __shelve_records(self, table, chunk, shelve, shelved = None):
+        started_at = time.time()
+        primary_keys = chunk.primary_keys()
+        references = list(chunk.references())
+        # rows of the chunk are counted once, when rendered
+        metrics.add(table, 'encode', time.time() - started_at, calls = 0)
+        if shelve:
+            self.cupboard.put_on_shelf(table, *primary_keys)
+            if shelved is not None:
+                shelved.extend(primary_keys)
+        return (chunk, primary_keys, references,)
 
     def persist_references(self):
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while self.cupboard.has_pending_references():
+                print('Iteration over references')
+                started_at = time.time()
+                tasks = dict()
+                for table, record_keys in self.cupboard.get_all_references():
+                    record_keys = list(record_keys)
+                    tasks[table] = list()
+                    # very large key sets of a single table are spread across workers as well
+                    for offset in range(0, len(record_keys), self.reference_split_size):
+                        tasks[table].append(executor.submit(
+                            self.persist_table_references,
+                            table,
+                            record_keys[offset:offset+self.reference_split_size]
+                        ))
+                failed = False
+                keys = 0
+                for table, table_tasks in tasks.items():
+                    results = [task.result() for task in table_tasks]
+                    if all([done for done, _ in results]):
+                        self.cupboard.release_references(table)
+                    else:
+                        failed = True
+                    keys += sum([count for _, count in results])
+                metrics.add_iteration(len(tasks), keys, time.time() - started_at)
+                # unreleased references are handed out again by a resumed run
+                if failed:
+                    print('Copying references failed, run again with --continue to resume')
+                    return
+
+    def persist_table_references(self, table, record_keys):
+        reader = copy(self.registry.get_table_reader(table))
+        writer_settings = self.__writer_settings(table)
         read_connection = self.read_connector()
-        write_connection = self.write_connector()
-        references = set()
+        write_connection = None
+        started_at = time.time()
+        try:
+            write_connection = self.write_connector()
+            writer = self.__create_table_writer(table, write_connection, writer_settings)
+            reader.set_connection(read_connection)
+            done = self.__persist_references(table, record_keys, reader, writer, read_connection)
+        finally:
+            if write_connection:
+                write_connection.close()
+            read_connection.close()
+        metrics.add(table, 'references', time.time() - started_at, len(record_keys))
 
-        while self.cupboard.has_pending_references():
-            print('Iteration over references')
-            for table, record_keys in self.cupboard.get_all_references():
-                offset = 0;
-                chunk_size = 5000
-                table = table.decode('utf-8')
-                reader = self.registry.get_table_reader(table)
-                writer = self.__create_table_writer(table, write_connection)
-                record_keys = list(record_keys)
-                reader.set_connection(read_connection)
+        return (done, len(record_keys),)
 
-                try:
-                    while offset < len(record_keys):
-                        keys = record_keys[offset:offset+chunk_size]
-                        records = reader.get_records(*keys)
-                        offset += chunk_size
-                        new_record_keys = list()
-                        for record in records:
-                            new_record_keys.append(record['primary_key'])
-                            for ref_table, primary_key in record['references'].items():
-                                if primary_key:
-                                    references.add((ref_table, primary_key,))
-                        self.cupboard.put_on_shelf(table, *new_record_keys)
-                        writer.persist(*records, ignore_duplicates = True)
-                    print('References for table "' + table + '":', len(record_keys))
+    def __persist_references(self, table, record_keys, reader, writer, read_connection):
+        offset = 0
+        chunk_size = 5000
+        primary_keys = list()
+        references = set()
+        done = False
+
+        try:
+            while offset < len(record_keys):
+                keys = record_keys[offset:offset+chunk_size]
+                fetch_started_at = time.time()
+                records = reader.get_records(*keys)
+                metrics.add(table, 'fetch', time.time() - fetch_started_at, len(records))
+                offset += chunk_size
+                references.update(records.references())
+                primary_keys.extend(records.primary_keys())
+                writer.persist(records, ignore_duplicates = True)
+                if writer.commit_due():
                     writer.commit()
-                    self.cupboard.put_on_reference_shelf(references)
-                except:
-                    print('Error when copying references to "%s"' % (table,))
-                    print(sys.exc_info()[1])
-                    if read_connection.errno():
-                        print(read_connection.error())
-                    self.cupboard.clear_shelf(table)
-                    writer.rollback()
-
-        read_connection.close()
-        write_connection.close()
-
-    def __create_table_writer(self, table, connection):
-        fields = self.registry.metadata[table]['fields']['__order__']
-        return TableWriter(table, fields, connection)
+                    self.__shelve_committed(table, primary_keys, references)
+            print('References for table "' + table + '":', len(record_keys))
+            writer.commit()
+            # keys are shelved once committed only, so a failed batch is retried (with IGNORE)
+            self.__shelve_committed(table, primary_keys, references)
+            done = True
+        except:
+            print('Error when copying references to "%s"' % (table,))
+            print(sys.exc_info()[1])
+            if read_connection.errno():
+                print(read_connection.error())
+            writer.rollback()
+
+        return done
+
+    def __writer_settings(self, table):
+        options = dict(self.writer_options)
+        backend = options.pop('backend', 'insert')
+        assert backend in WRITER_BACKENDS, 'Unknown writer backend %s' % (backend,)
+        # per table settings override global ones
+        options.update((options.pop('tables', None) or {}).get(table) or {})
+        return (WRITER_BACKENDS[backend], options,)
+
+    def __create_table_writer(self, table, connection, settings):
+        writer_class, options = settings
+        return writer_class(table, self.registry.metadata[table]['fields'], connection, **options)
 
 class TableWriter:
-    def __init__(self, table, fields, connection):
+    # session settings relaxed in fast load mode, the write user may not be allowed to change some
+    __FAST_LOAD_SETTINGS = [
+        'SET SESSION unique_checks=0',
+        'SET SESSION sql_log_bin=0',
+    ]
+
+    def __init__(self, table, fields, connection, commit_rows = 100000, commit_bytes = 0, fast_load = False):
         self.table = table
-        self.fields = fields
+        self.fields = fields['__order__']
         self.connection = connection
+        # transaction is committed once either limit is reached, no limits - one transaction per task
+        self.commit_rows = commit_rows
+        self.commit_bytes = commit_bytes
+        self.periodic = bool(commit_rows or commit_bytes)
+        self.pending_rows = 0
+        self.pending_bytes = 0
         cursor = connection.cursor()
         cursor.execute('SET FOREIGN_KEY_CHECKS=0')
+        if fast_load:
+            for setting in self.__FAST_LOAD_SETTINGS:
+                try:
+                    cursor.execute(setting)
+                except _mysql.MySQLError as error:
+                    print('Fast load setting "%s" skipped: %s' % (setting, error,))
         cursor.close()
         connection.autocommit(False)
 
-    def persist(self, *records, **opts):
-        fields = ['`%s`' % (field,) for field in self.fields]
-        if 'ignore_duplicates' in opts and opts['ignore_duplicates']:
-            sql = 'INSERT IGNORE INTO `%s` (%s) VALUES' % (self.table, ', '.join(fields),)
-        else:
-            sql = 'INSERT INTO `%s` (%s) VALUES' % (self.table, ', '.join(fields),)
-        offset = 0
-        chunk_size = 500
-        while offset < len(records):
-            complete_sql = sql
-            for record in records[offset:offset+chunk_size]:
-                complete_sql += '\n' + record['record'] + ','
-            offset += chunk_size
-            self.connection.query(complete_sql[:-1])
+    # rows are encoded ahead of writing, by the conversion stage of the pipeline where there is one
+    def render(self, chunk):
+        if chunk.rendered is None:
+            started_at = time.time()
+            chunk.rendered = self.render_rows(chunk)
+            metrics.add(self.table, 'encode', time.time() - started_at, len(chunk))
+        return chunk
+
+    def render_rows(self, chunk):
+        return list(chunk.sql_values())
+
+    def persist(self, chunk, **opts):
+        values = self.render(chunk).rendered
+        started_at = time.time()
+        pending_bytes = self.pending_bytes
+        ignore = 'ignore_duplicates' in opts and opts['ignore_duplicates']
+        upsert = 'upsert' in opts and opts['upsert']
+        for statement in insert_statements(self.table, self.fields, values, ignore, upsert):
+            self.connection.query(statement)
+            self.pending_bytes += len(statement)
+        self.pending_rows += len(chunk)
+        metrics.add(self.table, 'persist', time.time() - started_at, len(chunk), self.pending_bytes - pending_bytes)
+
+    def commit_due(self):
+        return bool(self.commit_rows and self.pending_rows >= self.commit_rows) \
+            or bool(self.commit_bytes and self.pending_bytes >= self.commit_bytes)
 
     def commit(self):
         self.connection.commit()
+        self.pending_rows = 0
+        self.pending_bytes = 0
 
     def rollback(self):
         self.connection.rollback()
+        self.pending_rows = 0
+        self.pending_bytes = 0
+
+class BulkTableWriter(TableWriter):
+    __TSV_ESCAPE = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r', '\0': '\\0'})
+    __ZERO_VALUES = {
+        'date': '0000-00-00',
+        'time': '00:00:00',
+        'datetime': '0000-00-00 00:00:00',
+    }
+
+    def __init__(self, table, fields, connection, **options):
+        super().__init__(table, fields, connection, **options)
+        # NOT NULL temporal columns get zero values, same as with INSERT statements
+        self.zero_values = [
+            self.__ZERO_VALUES.get(fields[field]['type']) if fields[field]['null'] != 'YES' else None
+            for field in self.fields
+        ]
+
+    def render_rows(self, chunk):
+        return ['\t'.join(map(self.__tsv_value, record_data, self.zero_values)) + '\n' for record_data in chunk.rows]
+
+    def persist(self, chunk, **opts):
+        if not len(chunk):
+            return
+        lines = self.render(chunk).rendered
+        started_at = time.time()
+        pending_bytes = self.pending_bytes
+        fields = ['`%s`' % (field,) for field in self.fields]
+        if 'upsert' in opts and opts['upsert']:
+            # rows are deleted and inserted again, foreign key checks are off for write sessions
+            ignore = 'REPLACE '
+        else:
+            ignore = 'IGNORE ' if 'ignore_duplicates' in opts and opts['ignore_duplicates'] else ''
+        sql = "LOAD DATA LOCAL INFILE %s " + ignore + "INTO TABLE `" + self.table + "` CHARACTER SET utf8" + \
+            " FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n'" + \
+            " (" + ', '.join(fields) + ")"
+        with NamedTemporaryFile('w', encoding='utf-8', errors='surrogateescape', newline='', suffix='.tsv') as data:
+            data.writelines(lines)
+            data.flush()
+            cursor = self.connection.cursor()
+            cursor.execute(sql, (data.name,))
+            cursor.close()
+            self.pending_bytes += data.tell()
+        self.pending_rows += len(chunk)
+        metrics.add(self.table, 'persist', time.time() - started_at, len(chunk), self.pending_bytes - pending_bytes)
+
+    def __tsv_value(self, value, zero_value):
+        if not value and zero_value:
+            return zero_value
+        if value is None:
+            return '\\N'
+        if isinstance(value, bytes):
+            value = value.decode('utf-8', 'surrogateescape')
+        return str(value).translate(self.__TSV_ESCAPE)
+
+# multi-row INSERT statements of at most batch_size rows (rendered SQL values) each,
+# with upsert existing rows get the values of new ones
+def insert_statements(table, fields, values, ignore_duplicates = False, upsert = False, batch_size = 500):
+    sql = 'INSERT %sINTO `%s` (%s) VALUES\n' % (
+        'IGNORE ' if ignore_duplicates and not upsert else '', table, ', '.join(['`%s`' % (field,) for field in fields]),
+    )
+    update = '\nON DUPLICATE KEY UPDATE ' + ', '.join(['`%s`=VALUES(`%s`)' % (field, field,) for field in fields]) \
+        if upsert else ''
+    for offset in range(0, len(values), batch_size):
+        yield sql + ',\n'.join(values[offset:offset+batch_size]) + update
+
+def task_id(key_range):
+    return '%d-%d' % key_range if key_range else 'all'
+
+WRITER_BACKENDS = {
+    'insert': TableWriter,
+    'load_data': BulkTableWriter,
+}
 
 def cleanup(connection, tables: set):
     assert len(tables) > 0, 'Empty table list'
@@ -136,3 +480,68 @@ def cleanup(connection, tables: set):
             cursor.execute('TRUNCATE TABLE `%s`' % (table,))
 
     cursor.close()
+
+class PipelineFailure:
+    def __init__(self, error):
+        self.error = error
+
+PIPELINE_END = object()
+
+# runs the source and every stage in own threads connected by queues of at most
+# `depth` items and yields results of the last stage; depth 0 runs everything inline
+def pipeline(source, stages, depth):
+    if not depth:
+        for item in source:
+            for stage in stages:
+                item = stage(item)
+            yield item
+        return
+
+    stop = threading.Event()
+    queues = [queue.Queue(depth) for _ in range(len(stages) + 1)]
+
+    def put(output, item):
+        while not stop.is_set():
+            try:
+                output.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def drain(input):
+        while not stop.is_set():
+            try:
+                item = input.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is PIPELINE_END:
+                return
+            if isinstance(item, PipelineFailure):
+                raise item.error
+            yield item
+
+    def work(items, stage, output):
+        try:
+            for item in items:
+                if not put(output, stage(item)):
+                    return
+            put(output, PIPELINE_END)
+        except BaseException as error:
+            put(output, PipelineFailure(error))
+        finally:
+            # generators (e.g. reading cursors) have to be closed in their own thread
+            if hasattr(items, 'close'):
+                items.close()
+
+    workers = [threading.Thread(target=work, args=(source, lambda item: item, queues[0]), daemon=True)]
+    for position, stage in enumerate(stages):
+        workers.append(threading.Thread(target=work, args=(drain(queues[position]), stage, queues[position + 1]), daemon=True))
+    for worker in workers:
+        worker.start()
+    try:
+        yield from drain(queues[-1])
+    finally:
+        stop.set()
+        for worker in workers:
+            worker.join()
@@ -1,8 +1,10 @@
 from getopt import getopt,GetoptError
 import MySQLdb
 import yaml
+import re
 import subprocess
-import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
 from os.path import isfile
 
 def usage():
@@ -11,17 +13,31 @@ def usage():
     -h, --help            - shows help information
     -r, --read ...        - specify name of read connection
     -w, --write ...       - specify name of write connection
-    -c, --continue        - don't empty Redis db and don't truncate tables
+    -c, --continue        - don't empty Redis db and don't truncate tables,
+                            resume from saved checkpoints
     -t, --tables ...      - comma separated list of tables
+        --incremental     - copies only rows changed since the previous run into existing
+                            target tables (overwriting them), keeps Redis db
         --copy-schema     - copies schema from source database
                             (target database will be deleted and recreated)
+        --engine ...      - threads (default) or async
+        --plan            - estimates rows and size to copy and reference iterations,
+                            warns of rules scanning whole tables; nothing is copied
+        --report ...      - path to save JSON report with per table and phase metrics to
+        --defer-indexes   - with --copy-schema creates tables with primary and unique keys only,
+                            other secondary indexes and foreign keys are added after copying
     ''')
 
 def resolve_settings(argv):
     read_connection = None
     write_connection = None
     cleanup = True
+    incremental = False
     copy_schema = False
+    defer_indexes = False
+    report_file = None
+    plan = False
+    engine = 'threads'
     table_list = []
     schema_file = './schema.yml'
 
@@ -29,7 +45,7 @@ def resolve_settings(argv):
         opts, args = getopt(
             argv,
             'hr:w:ct:',
-            ['help', 'read=', 'write=', 'continue', 'tables=', 'copy-schema', 'schema-file=']
+            ['help', 'read=', 'write=', 'continue', 'tables=', 'incremental', 'copy-schema', 'defer-indexes', 'report=', 'plan', 'engine=', 'schema-file=']
         )
     except GetoptError:
         usage()
@@ -46,8 +62,18 @@ def resolve_settings(argv):
             cleanup = False
         elif opt in ("-t", "--tables"):
             table_list = arg.split(",")
+        elif opt in ("--incremental",):
+            incremental = True
         elif opt in ("--copy-schema",):
             copy_schema = True
+        elif opt in ("--defer-indexes",):
+            defer_indexes = True
+        elif opt in ("--engine",):
+            engine = arg
+        elif opt in ("--plan",):
+            plan = True
+        elif opt in ("--report",):
+            report_file = arg
         elif opt in ("--schema-file",):
             schema_file = arg
 
@@ -55,6 +81,10 @@ def resolve_settings(argv):
         raise RuntimeError("Read connection name is not specified")
     if not write_connection:
         raise RuntimeError("Write connection name is not specified")
+    if engine not in ('threads', 'async',):
+        raise RuntimeError("Unknown engine %s" % (engine,))
+    if incremental and copy_schema:
+        raise RuntimeError("Incremental runs need existing target tables, schema can't be copied")
     if schema_file:
         assert isfile(schema_file), 'Path to schema file is wrong.'
 
@@ -62,13 +92,18 @@ def resolve_settings(argv):
         "read": read_connection,
         "write": write_connection,
         "cleanup": cleanup,
+        "incremental": incremental,
         "tables": table_list,
         "copy_schema": copy_schema,
+        "defer_indexes": defer_indexes,
+        "report_file": report_file,
+        "plan": plan,
+        "engine": engine,
         "schema_file": schema_file,
     }
 
-def get_connection_factory(*parameter_sets):
-    _conns = itertools.cycle([{
+def connection_parameters(parameters, **options):
+    return dict({
         'host': parameters["host"],
         'port': parameters["port"],
         'user': parameters["user"],
@@ -76,9 +111,7 @@ def get_connection_factory(*parameter_sets):
         'db': parameters["database"],
         'use_unicode': True,
         'charset': "utf8"
-    } for parameters in parameter_sets])
-
-    return lambda: MySQLdb.connect(**next(_conns))
+    }, **options)
 
 def mysql_cmd_string(params: dict, cmd = 'mysql', select_db = False):
     return cmd + \
@@ -88,11 +121,14 @@ def mysql_cmd_string(params: dict, cmd = 'mysql', select_db = False):
         ' -P"%s"' % (str(params['port']) if params['port'] else '3306',) + \
         ' ' + (params['database'] if select_db else '')
 
-def copy_database_schema(data_registry, write_connection):
+def copy_database_schema(data_registry, write_connection, defer_indexes = False):
     write_connection.query('SET FOREIGN_KEY_CHECKS=0')
+    deferred = dict()
 
     for table in data_registry.tables:
         create_sql = data_registry.get_create_table(table)
+        if defer_indexes:
+            create_sql, deferred[table] = split_secondary_indexes(create_sql)
         write_connection.query('DROP TABLE IF EXISTS `%s`' % (table,))
         write_connection.query(create_sql)
 
@@ -104,3 +140,70 @@ def copy_database_schema(data_registry, write_connection):
         else:
             raise RuntimeError('Unknown routine type: %s' % (routine.type,))
         write_connection.query(routine.create_sql)
+
+    return deferred
+
+SECONDARY_INDEX = re.compile(r'^\s*(?:FULLTEXT |SPATIAL )?KEY `[^`]+` \(`([^`]+)`|^\s*CONSTRAINT `[^`]+` FOREIGN KEY ')
+AUTO_INCREMENT_COLUMN = re.compile(r'^\s*`([^`]+)` .* AUTO_INCREMENT\b')
+
+# splits secondary indexes and foreign keys out of SHOW CREATE TABLE statement, the primary key,
+# unique keys (duplicates are skipped or upserted against them while copying, and tables without
+# a primary key are keyed by one) and indexes on AUTO_INCREMENT column (it has to be first in some index) stay in place
+def split_secondary_indexes(create_sql):
+    lines = create_sql.split('\n')
+    auto_increment = [match.group(1) for match in map(AUTO_INCREMENT_COLUMN.match, lines) if match]
+    kept = list()
+    deferred = list()
+    for line in lines:
+        match = SECONDARY_INDEX.match(line)
+        if match and (not match.group(1) or match.group(1) not in auto_increment):
+            deferred.append(line.strip().rstrip(','))
+        else:
+            kept.append(line)
+    # the last definition before closing parenthesis loses its comma
+    for position, line in enumerate(kept):
+        if line.startswith(')') and position > 0:
+            kept[position - 1] = kept[position - 1].rstrip(',')
+
+    return '\n'.join(kept), deferred
+
+def create_deferred_indexes(connector, deferred, workers = 1):
+    def create(table):
+        connection = connector()
+        started_at = time.time()
+        try:
+            connection.query('SET FOREIGN_KEY_CHECKS=0')
+            connection.query('ALTER TABLE `%s` %s' % (table, ', '.join(['ADD ' + index for index in deferred[table]]),))
+            print('Indexes of table "%s" created in %.1fs' % (table, time.time() - started_at,))
+            return True
+        except MySQLdb.Error as error:
+            print('Error when creating indexes of table "%s": %s' % (table, error,))
+            return False
+        finally:
+            connection.close()
+
+    tables = [table for table in deferred if deferred[table]]
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        return dict(zip(tables, executor.map(create, tables)))
+
+# innodb_flush_log_at_trx_commit is server wide and needs SUPER (SYSTEM_VARIABLES_ADMIN) privilege,
+# returns the former value to restore or None when it can't be changed
+def relax_durability(connection):
+    cursor = connection.cursor()
+    try:
+        cursor.execute('SELECT @@GLOBAL.innodb_flush_log_at_trx_commit')
+        flush_log = cursor.fetchone()[0]
+        cursor.execute('SET GLOBAL innodb_flush_log_at_trx_commit=2')
+    except MySQLdb.Error as error:
+        print('Durability settings are kept:', error)
+        flush_log = None
+    cursor.close()
+
+    return flush_log
+
+def restore_durability(connection, flush_log):
+    if flush_log is None:
+        return
+    cursor = connection.cursor()
+    cursor.execute('SET GLOBAL innodb_flush_log_at_trx_commit=%d' % (int(flush_log),))
+    cursor.close()